@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+"""Feed discovery
+
+Streams are created with whatever URL the user typed, which may be a web
+page rather than a feed.  find_feed_url() checks the URL and looks for the
+page's feed if it isn't one.  Crawling third party sites is slow, so when
+FeedBotConfig.async_create is on FeedBot stores the stream as resolving
+and queue_resolve() hands the discovery to a task.  Either way
+follow_feed() then points the stream at the shared FeedSource for its feed.
+
+robots.txt rules and discovery results are kept in SharedCaches, so every
+instance benefits from what any of them fetched or found.
+"""
+
+# Python imports
+import hashlib
+import logging
+import pickle
+from datetime import datetime, timedelta
+
+# AppEngine imports
+import wsgiref.handlers
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+from google.appengine.ext import webapp
+
+# 3rd party library imports
+from lib import feedfinder
+
+# our own imports
+from lib.feedfetcher import FeedFinderGatekeeper, HostLimiter
+from models import FeedSource, FeedStream, CacheEntry
+
+ROBOTS_CACHE_TIME = 24 * 60 * 60
+FEED_URL_CACHE_TIME = 24 * 60 * 60
+# sites without a feed get another look sooner
+NO_FEED_CACHE_TIME = 60 * 60
+
+
+class SharedCache(object):
+  """Cache with a time to live shared by all instances.
+
+  Values live in memcache and in the datastore, which refills memcache
+  after an eviction.  Hits and misses are counted in memcache.  None can't
+  be cached.
+  """
+  def __init__(self, namespace, ttl):
+    self.namespace = namespace
+    self.ttl = ttl
+
+  def _cache_key(self, key):
+    if isinstance(key, unicode):
+      key = key.encode('utf-8')
+    return "%s_%s" % (self.namespace, hashlib.sha1(key).hexdigest())
+
+  def get(self, key, default=None):
+    cache_key = self._cache_key(key)
+    value = memcache.get(cache_key)
+    if value is None:
+      entry = CacheEntry.get_by_key_name(cache_key)
+      now = datetime.utcnow()
+      if entry is not None and entry.expires > now:
+        value = pickle.loads(entry.value)
+        left = entry.expires - now
+        memcache.set(cache_key, value, time=left.days * 24 * 60 * 60 + left.seconds + 1)
+      elif entry is not None:
+        entry.delete()
+    self._count(value is not None)
+    if value is None:
+      return default
+    return value
+
+  def set(self, key, value, ttl=None):
+    ttl = ttl or self.ttl
+    cache_key = self._cache_key(key)
+    if not memcache.set(cache_key, value, time=ttl):
+      logging.error("memcache set failed")
+    CacheEntry(key_name=cache_key, value=pickle.dumps(value, 2),
+               expires=datetime.utcnow() + timedelta(seconds=ttl)).put()
+
+  def __setitem__(self, key, value):
+    self.set(key, value)
+
+  def _count(self, hit):
+    counter = "cache_%s_%s" % (hit and "hits" or "misses", self.namespace)
+    memcache.incr(counter, initial_value=0)
+
+  def stats(self):
+    """Hits and misses counted since memcache last lost the counters"""
+    counts = memcache.get_multi(["cache_hits_%s" % self.namespace, "cache_misses_%s" % self.namespace])
+    hits = int(counts.get("cache_hits_%s" % self.namespace) or 0)
+    misses = int(counts.get("cache_misses_%s" % self.namespace) or 0)
+    hit_rate = "-"
+    if hits + misses > 0:
+      hit_rate = "%d%%" % (100 * hits / (hits + misses))
+    return {"name": self.namespace, "hits": hits, "misses": misses, "hit_rate": hit_rate}
+
+
+robots_cache = SharedCache("robots", ROBOTS_CACHE_TIME)
+feed_url_cache = SharedCache("feed_url", FEED_URL_CACHE_TIME)
+
+# probe candidate feeds with concurrent urlfetch calls, within the hosts' budgets the pollers use too
+feedfinder.setGatekeeper(FeedFinderGatekeeper(rpcache=robots_cache, limiter=HostLimiter()))
+
+
+def purge_expired_entries(batch_size=200):
+  """Delete expired CacheEntry rows in batches, the ones nobody reads again pile up otherwise"""
+  keys = CacheEntry.all(keys_only=True).filter('expires <', datetime.utcnow()).fetch(batch_size)
+  if len(keys) > 0:
+    db.delete(keys)
+  if len(keys) == batch_size:
+    deferred.defer(purge_expired_entries, batch_size)
+  else:
+    logging.info("expired cache entries purged")
+
+
+class CacheCleanup(webapp.RequestHandler):
+  """Cron entry point for purging expired cache entries"""
+  def get(self):
+    deferred.defer(purge_expired_entries)
+    self.response.out.write("cache cleanup started")
+
+
+def cache_stats():
+  return [robots_cache.stats(), feed_url_cache.stats()]
+
+
+def find_feed_url(url):
+  """Validate that the URL is a real feed, or try to find the feed if not"""
+  feed_url = feed_url_cache.get(url)
+  if feed_url is not None:
+    # '' means we looked and there was no feed
+    return feed_url or None
+
+  if feedfinder.isFeed(url):
+    feed_url = url
+  else:
+    feed_url = feedfinder.feed(url)
+  if feed_url:
+    feed_url_cache[url] = feed_url
+    return feed_url
+  feed_url_cache.set(url, '', NO_FEED_CACHE_TIME)
+  return None
+
+
+def follow_feed(stream, feed_url):
+  """Point the stream at the shared source for feed_url and store it.
+
+  Safe to retry: the source counts each stream as a follower only once.
+  """
+  source, needs_poll = FeedSource.follow(feed_url, stream.key())
+  stream.url = feed_url
+  stream.source = source
+  stream.put()
+  stream.invalidate_cache()
+  if needs_poll:
+    # get an inital fetch of the feed ASAP, a source that is polled already has items
+    taskqueue.add(url='/feedpoller/tasks/poll', params={"key": str(source.key())})
+  return source
+
+
+def queue_resolve(stream):
+  """Find the stream's feed url in the background"""
+  taskqueue.add(url='/discovery/tasks/resolve', params={"key": str(stream.key())})
+
+
+class ResolveWorker(webapp.RequestHandler):
+  """Resolve the feed url of a stream created in the resolving state"""
+  def post(self):
+    stream = FeedStream.get(db.Key(self.request.get("key")))
+    if stream is None or stream.deleted or stream.current_status() != FeedStream.STATUS_RESOLVING:
+      self.response.out.write("nothing to resolve")
+      return
+
+    try:
+      feed_url = find_feed_url(stream.url)
+    except Exception, e:
+      # a retry would most likely fail the same way, and the default queue retries forever
+      logging.warn("feed discovery failed for stream %s at %s: %r" % (stream.stream_id, stream.url, e))
+      feed_url = None
+    if feed_url is None:
+      logging.warn("no feed found for stream %s at %s" % (stream.stream_id, stream.url))
+      stream.status = FeedStream.STATUS_FAILED
+      stream.put()
+      stream.invalidate_cache()
+      self.response.out.write("no feed found")
+      return
+
+    stream.status = FeedStream.STATUS_ACTIVE
+    follow_feed(stream, feed_url)
+    logging.info("resolved stream %s to %s" % (stream.stream_id, feed_url))
+    self.response.out.write("stream resolved")
+
+
+def main():
+  logging.getLogger().setLevel(logging.DEBUG)
+  application = webapp.WSGIApplication([
+          (r'/discovery/tasks/resolve', ResolveWorker),
+          (r'/discovery/cleanup', CacheCleanup)
+          ], debug=True)
+  wsgiref.handlers.CGIHandler().run(application)
+
+if __name__ == "__main__":
+  main()
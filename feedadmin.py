@@ -11,13 +11,16 @@ from datetime import datetime
 import wsgiref.handlers
 from google.appengine.api import memcache
 from google.appengine.ext import db
+from google.appengine.ext import deferred
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 from google.appengine.ext.webapp import util
 from django.template import TemplateDoesNotExist
 
 # our own imports
-from models import FeedStream, FeedItem, FeedPollerConfig
+from discovery import cache_stats
+from feedpoller import poller_status, purge_source_items, queue_reshard
+from models import FeedSource, FeedStream, FeedItem, FeedBotConfig, FeedPollerConfig, MavennDeliveryConfig
 
 
 class BaseHandler(webapp.RequestHandler):
@@ -50,12 +53,31 @@ class BaseHandler(webapp.RequestHandler):
 
 class SettingsHandler(BaseHandler):
   def get(self):
-    poller_running = memcache.get("feed_poller_running") or False
-    self.generate('admin/settings.html', { "poller_running": poller_running })
+    delivery = MavennDeliveryConfig.get_instance()
+    feedbot = FeedBotConfig.get_instance()
+    poller = FeedPollerConfig.get_instance()
+    self.generate('admin/settings.html', { "shards": poller_status(), "delivery": delivery, "feedbot": feedbot,
+                                           "poller": poller, "cache_stats": cache_stats() })
 
   def post(self):
-    runit = self.request.get('poller_running', default_value=None) != None 
-    memcache.set("feed_poller_running", runit)
+    deliver = self.request.get('deliver_to_mavenn', default_value=None) != None
+    delivery = MavennDeliveryConfig.get_instance()
+    if deliver and not delivery.is_enabled:
+      delivery.enabled_since = datetime.utcnow()
+    delivery.is_enabled = deliver
+    delivery.put()
+
+    feedbot = FeedBotConfig.get_instance()
+    feedbot.async_create = self.request.get('async_create', default_value=None) != None
+    feedbot.put()
+
+    shards = self.request.get('poller_shards')
+    poller = FeedPollerConfig.get_instance()
+    if shards.isdigit() and int(shards) > 0 and int(shards) != poller.shards:
+      poller.shards = int(shards)
+      poller.put()
+      # feeds move to the shard they belong to under the new count
+      queue_reshard()
     self.redirect('/admin/settings')
   
 
@@ -68,7 +90,7 @@ class ListHandler(BaseHandler):
 class ViewHandler(BaseHandler):
   def get(self, key):
     stream = FeedStream.get_by_key_name("z%s" % key)    
-    items = stream.items.order('-updated').fetch(10)
+    items = stream.item_query().order('-updated').fetch(10)
     self.generate('admin/view.html', { "items": items, "stream": stream })
 
 
@@ -80,8 +102,12 @@ class DeleteHandler(BaseHandler):
   def post(self, key):
     stream = FeedStream.get_by_key_name("z%s" % key)
     db.delete(stream.items)
-    stream.deleted = True
-    stream.put()
+    deleted = stream.mark_deleted()
+    stream.invalidate_cache()
+    # the source's items go too once no other stream follows it
+    source_key = stream.source_key()
+    if deleted and source_key is not None and FeedSource.unfollow(source_key, stream.key()):
+      deferred.defer(purge_source_items, source_key)
     self.redirect('/admin/')
     
 
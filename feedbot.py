@@ -3,6 +3,7 @@
 # Python imports
 import os
 import base64
+import hashlib
 import logging
 import uuid
 from datetime import datetime
@@ -21,17 +22,22 @@ from django.template import TemplateDoesNotExist
 from django.utils import simplejson
 
 # 3rd party library imports
-from lib import feedfinder
 from lib import feedparser
 
 # our own imports
 from lib.watchbot import Watchbot
-from models import FeedStream, FeedItem, FeedPollerConfig
+from discovery import find_feed_url, follow_feed, queue_resolve
+from feedpoller import queue_backfill, queue_fanout, watchdog
+from models import FeedSource, FeedStream, FeedItem, FeedBotConfig, FeedPollerConfig
 from config import *
 
 
 class FeedBot(Watchbot):
   """Mavenn Bot for handling RSS and Atom Feeds"""
+
+  DEFAULT_PAGE_SIZE = 20
+  MAX_PAGE_SIZE = 100
+  RESPONSE_CACHE_TIME = 60 * 60
   
   def list(self):
     """List the streams created for this bot"""
@@ -49,20 +55,20 @@ class FeedBot(Watchbot):
     if streamform.is_valid():
       # shortcut to instantiate entity from form
       feed = streamform.save(commit=False)
+      feed.deleted = False
+      feed.pshb_is_subscribed = False
+      feed.pshb_verify_token = str(uuid.uuid4())
+      feed._key_name = "z%s" % feed.stream_id
+
+      if FeedBotConfig.get_instance().async_create:
+        self._create_resolving(feed)
+        return
       
       # Find the best url (i.e. if a non-feed url passed in, find the feed)
       feed_url = self._find_url_for_feed(feed.url)
       if feed_url:
-        feed.url = feed_url
-        feed.deleted = False
-        feed.pshb_is_subscribed = False
-        feed.pshb_verify_token = str(uuid.uuid4())
-        feed._key_name = "z%s" % feed.stream_id
-        feed.put()
-
-        # get an inital fetch of the feed ASAP
-        taskqueue.add(url='/feedpoller/tasks/poll', params={"key":str(feed.key())})
-        #key().name()
+        # streams of the same feed share one source, fetched once for all of them
+        follow_feed(feed, feed_url)
         
         # attempt to subscribe to feed via PubSubHubBub
         #taskqueue.add(url='/subscriber/subscribe', params={"key":str(feed.key())})
@@ -77,6 +83,19 @@ class FeedBot(Watchbot):
     self.response.out.write('{"status": "failed", "message": "stream was not created"}')
     return
 
+  def _create_resolving(self, feed):
+    """Store the stream right away and leave finding the feed to a task"""
+    feed.status = FeedStream.STATUS_RESOLVING
+    feed.put()
+    queue_resolve(feed)
+
+    status_url = "/feeds/%s.json" % feed.stream_id
+    self.response.set_status(202)
+    self.response.headers['Content-Type'] = "application/json"
+    self.response.headers['Location'] = self.request.host_url + status_url
+    self.response.out.write(simplejson.dumps({"status": "accepted", "message": "stream is being created",
+                                              "status_url": status_url}))
+
   def update(self, stream_id):
     """Update the feed properties"""
     logging.debug("in feedbot update")
@@ -91,11 +110,18 @@ class FeedBot(Watchbot):
     # reset stream properties
     #stream.url = self.request.POST.get('url')
     stream.title = self.request.POST.get('title')
-    stream.http_status = None
-    stream.http_etag = None
-    stream.http_last_modified = None
-    stream.last_polled = datetime(1900,1,1)
-    stream.put()
+    if stream.current_status() == FeedStream.STATUS_ACTIVE:
+      stream.put()
+      if stream.source_key() is not None:
+        source = FeedSource.reset_validators(stream.source_key())
+        if source is not None:
+          source.invalidate_cache()
+    else:
+      # there is no feed url to poll yet, have another go at finding it
+      stream.status = FeedStream.STATUS_RESOLVING
+      stream.put()
+      queue_resolve(stream)
+    stream.invalidate_cache()
     self.response.out.write('{"status": "success", "message": "stream updated"}')
 
   def remove(self, stream_id):
@@ -109,20 +135,62 @@ class FeedBot(Watchbot):
       self.response.out.write('{"status": "failed", "message": "stream not found"}')
       return
 
-    stream.deleted = True
-    stream.put()
+    # only the request that deletes the stream lets go of its source
+    if stream.mark_deleted() and stream.source_key() is not None:
+      FeedSource.unfollow(stream.source_key(), stream.key())
+    stream.invalidate_cache()
     #TODO: unsubscribe from PubSubHubBub
     self.response.out.write('{"status": "success", "message": "stream deleted"}')
 
   def get_stream(self, stream_id):
     return FeedStream.get_by_key_name("z%s" % stream_id)    
 
+  def render(self, stream_id, format):
+    """Serve stream pages out of memcache until the stream changes"""
+    stream = self.get_stream(stream_id)
+    if stream is None or format not in (None, '.html', '.json'):
+      Watchbot.render(self, stream_id, format)
+      return
+
+    page = '&'.join(['%s=%s' % (name, self.request.get(name)) for name in ('limit', 'since', 'cursor')])
+    cache_key = "feedbot_response_%s_%s_%s_%s" % (stream.stream_id, stream.cache_generation(),
+                                                 format or '.html', hashlib.sha1(page.encode('utf-8')).hexdigest())
+    cached = memcache.get(cache_key)
+    if cached is None:
+      if format == '.json':
+        self.render_json(stream)
+      else:
+        self.render_html(stream)
+      if self.response.has_error():
+        return
+      body = self.response.out.getvalue()
+      if isinstance(body, unicode):
+        body = body.encode('utf-8')
+      cached = {"content_type": self.response.headers['Content-Type'],
+                "etag": '"%s"' % hashlib.sha1(body).hexdigest(),
+                "body": body}
+      try:
+        if not memcache.set(cache_key, cached, time=self.RESPONSE_CACHE_TIME):
+          logging.error("memcache set failed")
+      except ValueError:
+        # over memcache's value size limit, serve it uncached
+        logging.warn("response for stream %s too large to cache" % stream.stream_id)
+    else:
+      self.response.headers['Content-Type'] = cached["content_type"]
+      self.response.out.write(cached["body"])
+
+    self.response.headers['ETag'] = cached["etag"]
+    if_none_match = self.request.headers.get('If-None-Match', '')
+    if cached["etag"] in [etag.strip() for etag in if_none_match.split(',')]:
+      self.response.clear()
+      self.response.set_status(304)
+
   def render_html(self, stream):
     if stream is None:
       self.error(404)
       return
     
-    items = stream.items.order('-updated').fetch(10)
+    items = stream.item_query().order('-updated').fetch(10)
     self.generate('feed.html', {"items": items, "stream": stream})
 
   def render_json(self, stream):
@@ -132,54 +200,102 @@ class FeedBot(Watchbot):
       webapp.RequestHandler.error(self, 404)
       self.response.out.write('{"status": "failed", "message": "stream not found"}')
       return
+
+    try:
+      items, cursor = self._fetch_page(stream)
+    except (ValueError, db.BadValueError, db.BadRequestError), e:
+      logging.info("bad paging parameters for %s: %s" % (stream.stream_id, e))
+      webapp.RequestHandler.error(self, 400)
+      self.response.out.write('{"status": "failed", "message": "invalid limit, since or cursor"}')
+      return
     
-    output = {"status": "active", "stream_id": stream.stream_id}
-    output["activity"] = self._build_activities(stream)
+    output = {"status": stream.current_status(), "stream_id": stream.stream_id}
+    output["activity"] = self._build_activities(items)
+    if cursor is not None:
+      output["next"] = cursor
     self.response.out.write(simplejson.dumps(output))
+
+  def _fetch_page(self, stream):
+    """Fetch one page of the stream's items, newest first.
+
+    Honors the limit, since and cursor request parameters and returns the
+    items along with the cursor for the next page, or None on the last one.
+    Without a limit a page holds DEFAULT_PAGE_SIZE items.
+    """
+    query = stream.item_query().order('-published')
+    limit = int(self.request.get('limit') or self.DEFAULT_PAGE_SIZE)
+    limit = max(1, min(limit, self.MAX_PAGE_SIZE))
+
+    since = self.request.get('since')
+    if since:
+      if since.isdigit():
+        since = datetime.utcfromtimestamp(int(since))
+      else:
+        parsed = feedparser._parse_date(since)
+        if parsed is None:
+          raise ValueError("unrecognized date: %s" % since)
+        since = datetime(*parsed[:6])
+      query.filter('published >', since)
+
+    cursor = self.request.get('cursor')
+    if cursor:
+      query.with_cursor(cursor)
+
+    items = query.fetch(limit)
+    if len(items) < limit:
+      return items, None
+    return items, query.cursor()
   
-  def _build_activities(self, stream):
+  def _build_activities(self, items):
     activity = []
-    for item in stream.items:
+    for item in items:
       activity.append(item.to_activity())
     return activity
 
   def cron(self):
     """Wake up the feed poller"""
-    is_enabled = FeedPollerConfig.get_instance().is_enabled 
+    config = FeedPollerConfig.get_instance()
+    is_enabled = config.is_enabled
     if is_enabled is None or is_enabled == False:
       logging.debug("feed poller not enabled")
       self.response.out.write("feed poller not enabled")
       return
 
-    is_running = memcache.get("feed_poller_running")
-    if is_running is not None and is_running == True:
+    if not config.sources_backfilled:
+      queue_backfill()
+      config.sources_backfilled = True
+      db.put(config)
+
+    # in fan-out mode every wake up polls a fresh batch of stale feeds
+    if config.is_fanout:
+      if not queue_fanout():
+        logging.debug("feed poller already fanned out in this window")
+        self.response.out.write("feed poller already fanned out")
+        return
+      logging.debug("fanned out the feed poller")
+      self.response.out.write("fanned out the feed poller")
+      return
+
+    # the heartbeats tell which shards have no live chain, restart just those
+    started = watchdog()
+    if len(started) == 0:
       logging.debug("feed poller already running")
       self.response.out.write("feed poller already running")
       return
 
-    # Queue the poller    
-    if not memcache.set("feed_poller_running", True):
-      logging.error("memcache set failed")
-    task = taskqueue.Task(url='/feedpoller/tasks/poll', params={}).add(queue_name="feed-poller")
-
-    logging.debug("woke up the feed poller")
+    logging.debug("woke up feed poller shards %s" % started)
     self.response.out.write("woke up the feed poller")
 
   def _find_url_for_feed(self, url):
     """Validate that the URl is a real feed, or try to find the feed if not"""
-    if feedfinder.isFeed(url):
-      return url
-    feed_url = feedfinder.feed(url)
-    if feed_url:
-        return feed_url
-    return None
+    return find_feed_url(url)
     
 
 class FeedBotForm(djangoforms.ModelForm):
   """Class for use with django forms module"""
   class Meta:
     model = FeedStream
-    exclude = ['format','http_status','http_last_modified','http_etag','last_polled','deleted','pshb_is_subscribed','verify_token','pshb_hub_url','pshb_verify_token']
+    exclude = ['source','status','delivered_seq','deleted','pshb_is_subscribed','verify_token','pshb_hub_url','pshb_verify_token']
 
 
 def main():
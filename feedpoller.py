@@ -4,7 +4,10 @@
 import sys
 import os
 import base64
+import hashlib
 import logging
+import time
+import uuid
 from datetime import datetime, timedelta
 
 # AppEngine imports
@@ -13,6 +16,7 @@ from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.api import urlfetch
 from google.appengine.ext import db
+from google.appengine.ext import deferred
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 from google.appengine.ext.webapp import util
@@ -23,131 +27,423 @@ from django.utils import simplejson
 # 3rd party library imports
 from lib import feedfinder
 from lib import feedparser
+from lib.feedfetcher import FeedFetcher, FetchRequest, HostLimiter
 
 # our own imports
-from models import FeedStream, FeedItem, FeedPollerConfig
+from models import Configuration, FeedSource, FeedStream, FeedItem, FeedPollerConfig, ItemSequence, PollerHeartbeat
+from mavenn import queue_delivery
 from config import *
 
 
+# at most one fan-out, and one fanned out worker per shard, starts per window
+FANOUT_WINDOW = 5 * 60
+
+
+def queue_worker(shard, epoch=None, name=None):
+  """Queue a poll worker for the shard, workers with an epoch carry on the shard's chain"""
+  params = {"shard": shard}
+  if epoch is not None:
+    params["epoch"] = epoch
+  try:
+    taskqueue.Task(url='/feedpoller/tasks/poll', params=params, name=name).add(queue_name="feed-poller-workers")
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    # already started for this window
+    pass
+
+
+def queue_fanout():
+  """Queue the fan-out for the current window, unless it already was"""
+  window = int(time.time() / FANOUT_WINDOW)
+  try:
+    taskqueue.Task(url='/feedpoller/tasks/fanout', params={"window": window},
+                   name="fanout-%d" % window).add(queue_name="feed-poller")
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    return False
+  return True
+
+
+def start_chain(shard, epoch):
+  """Queue the first worker of a chain, named after its epoch so it is only queued once"""
+  try:
+    taskqueue.Task(url='/feedpoller/tasks/poll', params={"shard": shard, "epoch": epoch},
+                   name="poll-shard-%d-%d" % (shard, epoch)).add(queue_name="feed-poller-workers")
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def watchdog():
+  """Start a chain for every shard without a live one, returns the shards started"""
+  now = datetime.utcnow()
+  started = []
+  for shard, heartbeat in enumerate(PollerHeartbeat.for_shards(range(FeedSource.shard_count()))):
+    if heartbeat is not None and heartbeat.is_alive(now):
+      continue
+    epoch = PollerHeartbeat.take_over(shard)
+    if epoch is not None:
+      start_chain(shard, epoch)
+      started.append(shard)
+  return started
+
+
+def poller_status():
+  """Heartbeats of every shard for the admin pages, None for shards never started"""
+  return PollerHeartbeat.for_shards(range(FeedSource.shard_count()))
+
+
 class FeedPoller(webapp.RequestHandler):
   """Class that encapsulates the feed poller functions"""
+
+  # feeds on a host that is out of budget come back after this many seconds
+  HOST_BUSY_DELAY = 60
+  # seconds a single feed poll waits for its host's budget
+  SINGLE_FEED_PATIENCE = 10
+
   def post(self):
     # allow single feed to be updated
     key = self.request.get("key")
     if key is not None and len(key) > 0:
-      feed = FeedStream.get(db.Key(key))
-      if feed is None:
+      # tasks queued before sources carry stream keys, those have nothing to poll
+      key = db.Key(key)
+      if key.kind() != FeedSource.kind():
         self.response.out.write("no feed to update")
         return
-      self.update_feed(feed)
-      self.response.out.write("feed updated")
+      feed = FeedSource.claim(key, self.request.headers.get('X-AppEngine-TaskName') or str(uuid.uuid4()))
+      if feed is None:
+        self.response.out.write("feed is inactive or being polled already")
+        return
+      result = self.fetch_feed(feed)
+      self.update_feed(feed, result)
+      if result.deferred:
+        self.response.out.write("host busy, feed postponed")
+      else:
+        self.response.out.write("feed updated")
       return
 
-    # no key do the recursive polling
-    is_enabled = FeedPollerConfig.get_instance().is_enabled
-    if is_enabled is None or is_enabled == False:
+    config = FeedPollerConfig.get_instance()
+    if config.is_enabled is None or config.is_enabled == False:
       logging.info("feed poller not enabled shutting down")
       self.response.out.write("feed poller not enabled shutting down")
       return
 
-    # Get the stalest feed
-    feed = FeedStream.all().filter('deleted = ', False).order('last_polled').get()
+    shard = self.request.get("shard")
+    if not shard:
+      # a chain task from before shards, let the watchdog start the shard chains
+      watchdog()
+      self.response.out.write("started shard chains")
+      return
+    shard = int(shard)
+    if shard >= FeedSource.shard_count():
+      # the poller runs fewer shards now, reshard_sources() moved its feeds
+      logging.info("shard %d is no longer polled, stopping" % shard)
+      self.response.out.write("shard no longer polled")
+      return
+    epoch = self.request.get("epoch")
+    if epoch:
+      epoch = int(epoch)
+    else:
+      epoch = None
 
-    # Check how stale the stalest feed is, if it's been updated in the
-    # last 10 minutes, we should take a break
-    max_age = datetime.utcnow() - timedelta(minutes=10)
-    if feed.last_polled >= max_age:
-      if not memcache.set("feed_poller_running", False):
-        logging.error("memcache set failed")
-      logging.info("putting feed poller to sleep")
+    # lease a batch of due feeds, no other worker will poll them meanwhile
+    batch_size = max(config.batch_size or 1, 1)
+    owner = self.request.headers.get('X-AppEngine-TaskName') or str(uuid.uuid4())
+    feeds = FeedSource.claim_due(shard, owner, batch_size)
+
+    # If none are due, we should take a break
+    if len(feeds) == 0:
+      PollerHeartbeat.beat(shard, epoch, PollerHeartbeat.STATE_ASLEEP)
+      logging.info("putting feed poller shard %d to sleep" % shard)
       self.response.out.write("putting feed poller to sleep")
       return
 
-    # go get the feed
+    lag = datetime.utcnow() - min([feed.due_at for feed in feeds])
+    current = PollerHeartbeat.beat(shard, epoch, PollerHeartbeat.STATE_RUNNING, len(feeds),
+                                   max(lag.days * 24 * 60 * 60 + lag.seconds, 0))
+
+    # go get the feeds, they are leased to us even if our chain was superseded
+    self.poll_feeds(feeds)
+
+    # Queue the next batch, a one-off worker only carries on while there is a backlog
+    if epoch is not None and not current:
+      logging.info("chain %d of shard %d was superseded, stopping" % (epoch, shard))
+    elif epoch is not None or len(feeds) == batch_size:
+      queue_worker(shard, epoch)
+    self.response.out.write("%d feeds updated" % len(feeds))
+
+  def poll_feeds(self, feeds):
+    """Fetch a batch of feeds concurrently, then process each response"""
+    results = self.fetcher().fetch([self.fetch_request(feed) for feed in feeds])
+    for feed, result in zip(feeds, results):
+      logging.info("Fetched %s in %.3fs" % (feed.url, result.elapsed or 0))
+      self.poll_feed(feed, result)
+
+  def poll_feed(self, feed, result=None):
+    """Update the feed, flagging it as failed if anything goes wrong"""
     try:
-      self.update_feed(feed)
+      self.update_feed(feed, result)
     except:
-      logging.warn("Update Failed for feed with stream_id %s and url: %s" % (feed.stream_id, feed.url))
+      logging.warn("Update Failed for feed source %s and url: %s" % (feed.key().name(), feed.url))
       logging.error(sys.exc_info()[0])
       try:
         feed.last_polled = datetime.utcnow()
         feed.has_error = True
-        feed.put()
+        feed.schedule_next_poll(error=True)
+        self.save_feed(feed)
       except:
         logging.warn("failed to save feed error")
-    
-    # Queue the next feed
-    task = taskqueue.Task(url='/feedpoller/tasks/poll', params={}).add(queue_name="feed-poller")
-    self.response.out.write("feed updated")
 
-  def update_feed(self, feed):
+  def update_feed(self, feed, result=None):
     """Fetch the feed and process new items"""
-    d = self.parse_feed(feed)
+    if result is None:
+      result = self.fetch_feed(feed)
+
+    if result.deferred:
+      logging.info("Host busy, postponing feed: %s" % feed.url)
+      feed.postpone(self.HOST_BUSY_DELAY)
+      self.save_feed(feed)
+      return
+
+    # the server is overloaded or rate limiting us, back off at least as long as it asks
+    if result.error is None and result.status_code in (429, 503):
+      logging.info("Server asked us to back off (%s): %s" % (result.status_code, feed.url))
+      feed.http_status = str(result.status_code)
+      feed.last_polled = datetime.utcnow()
+      feed.schedule_next_poll(error=True)
+      feed.hold_off(result.retry_after())
+      self.save_feed(feed)
+      return
+
+    # nothing changed since our validators, there is nothing to parse
+    if result.error is None and result.status_code == 304:
+      feed.http_status = str(result.status_code)
+      if result.headers.get('etag'):
+        feed.http_etag = result.headers['etag']
+      feed.last_polled = datetime.utcnow()
+      feed.schedule_next_poll()
+      feed.hold_off(result.freshness())
+      self.save_feed(feed)
+      return
+
+    # plenty of feeds ignore our validators and send the same body every time
+    digest = None
+    if result.error is None and result.status_code == 200 and result.content:
+      digest = hashlib.sha1(result.content).hexdigest()
+      if digest == feed.content_digest:
+        logging.info("Feed body unchanged, skipping parse: %s" % feed.url)
+        feed.skipped_parses = (feed.skipped_parses or 0) + 1
+        feed.http_status = str(result.status_code)
+        feed.last_polled = datetime.utcnow()
+        feed.schedule_next_poll()
+        feed.hold_off(result.freshness())
+        self.save_feed(feed)
+        return
+
+    d = self.parse_feed(feed, result)
     if d is None:
       logging.warn("Parsing failed")
       feed.last_polled = datetime.utcnow()
-      feed.put()
+      feed.schedule_next_poll(error=True)
+      self.save_feed(feed)
       return
 
-    to_put = []
+    items = []
     for entry in d['entries']:
       item = FeedItem.process_entry(entry, feed)
       if item is not None:
-        item_exists = FeedItem.get_by_key_name(item._key_name)
-        if item_exists is None:
-          to_put.append(item)
-          # TODO: what about updates?
+        items.append(item)
 
-    if len(to_put) > 0:
-      db.put(to_put)
-      # self.update_mavenn_activity(feed.stream_id, to_put)
+    # only write what is new or was edited since we stored it, an RFC 3229
+    # delta (226) only carries those and merges into the stored items the same way
+    if result.status_code == 226:
+      feed.delta_polls = (feed.delta_polls or 0) + 1
+    new, changed, unchanged = FeedItem.classify(feed, items)
+    if len(new) + len(changed) > 0:
+      FeedItem.store(feed, new, changed)
+      feed.invalidate_cache()
+    if len(new) > 0:
+      queue_delivery(feed)
+    FeedItem.mark_seen(feed, items)
 
-    # update feedstream properties
+    # update feed source properties
     if hasattr(d, 'status'):
       feed.http_status = str(d.status)
       if hasattr(d, 'modified'):
         feed.http_last_modified = datetime(*d.modified[:6])
       if hasattr(d, 'etag'):
         feed.http_etag = d.etag
+    if digest is not None:
+      feed.content_digest = digest
     feed.last_polled = datetime.utcnow()
-    feed.put()
+    feed.schedule_next_poll(len(new), error=d.get('status', 200) >= 400)
+    feed.hold_off(result.freshness())
+    self.save_feed(feed)
     return
 
-  def parse_feed(self, feed):
-    """Helper method to handle conditional HTTP stuff"""
+  def save_feed(self, feed):
+    """Write the poll's results unless the feed's lease was lost meanwhile"""
+    if not feed.save_poll():
+      logging.warn("Lease on feed %s lost, dropping the poll's results" % feed.url)
+
+  def fetch_request(self, feed):
+    """Build the conditional GET for the feed"""
+    etag = None
+    if feed.http_etag is not None and len(feed.http_etag) > 0:
+      etag = feed.http_etag
+    return FetchRequest(feed.url, etag=etag, modified=feed.http_last_modified, key=feed.key())
+
+  def fetcher(self):
+    config = FeedPollerConfig.get_instance()
+    return FeedFetcher(limiter=HostLimiter(config.host_rate or 1, config.host_concurrency or 1))
+
+  def fetch_feed(self, feed):
+    """Fetch a single feed, waiting a little for its host's budget if need be"""
+    logging.info("Requesting Feed for: %s" % feed.url)
+    return self.fetcher().fetch([self.fetch_request(feed)], patience=self.SINGLE_FEED_PATIENCE)[0]
+
+  def parse_feed(self, feed, result=None):
+    """Parse the fetched feed, fetching it first if that hasn't happened yet"""
+    if result is None:
+      result = self.fetch_feed(feed)
+    if result.error is not None:
+      logging.warn("Fetch failed for feed: %s %r" % (feed.url, result.error))
+      return None
     try:
-      logging.info("Requesting Feed for: %s" % feed.url)
-      if feed.http_etag is not None and len(feed.http_etag) > 0 and feed.http_last_modified is not None:
-        # give feedparser back what it pulled originally, a time.struct_time object
-        return feedparser.parse(feed.url, etag=feed.http_etag, modified=feed.http_last_modified.timetuple())
-      if feed.http_etag is not None and len(feed.http_etag) > 0:
-        return feedparser.parse(feed.url, etag=feed.http_etag)
-      if feed.http_last_modified is not None:
-        # give feedparser back what it pulled originally, a time.struct_time object
-        return feedparser.parse(feed.url, modified=feed.http_last_modified.timetuple())
-      else:
-        return feedparser.parse(feed.url)
+      return feedparser.parse(result.to_resource(), fields=FeedItem.PARSED_FIELDS)
     except UnicodeDecodeError:
         logging.error("Unicode error parsing feed: %s" % feed.url)
         return None
 
-  def update_mavenn_activity(self, stream_id, items):
-    mavenn_activity_update = {"status": "active", "stream_id": stream_id}
-    activities = []
-    for item in items:
-      activities.append(item.to_activity())
-    mavenn_activity_update["activity"] = activities
-    activity = simplejson.dumps(mavenn_activity_update)
-    
-    logging.debug("notifying mavenn")
-    url = MAVENN_API_URL % stream_id
-    pair = "%s:%s" % (FEEDBOT_MAVENN_API_KEY, FEEDBOT_MAVENN_AUTH_TOKEN)
-    token = base64.b64encode(pair)
-    headers = {"Content-Type": "application/json", "Authorization": "Basic %s" % token}
-    result = urlfetch.fetch(url, payload=activity, method=urlfetch.POST,headers=headers)
-    logging.debug(result.status_code)
-    logging.debug(result.headers)
-    logging.debug(result.content)
+
+class FeedPollerFanout(webapp.RequestHandler):
+  """Start a one-off poll worker for every shard"""
+  def post(self):
+    config = FeedPollerConfig.get_instance()
+    if config.is_enabled is None or config.is_enabled == False:
+      logging.info("feed poller not enabled shutting down")
+      self.response.out.write("feed poller not enabled shutting down")
+      return
+
+    # sources are leased as workers claim them, so no two workers fetch the same feed
+    window = self.request.get("window") or int(time.time() / FANOUT_WINDOW)
+    shards = FeedSource.shard_count()
+    for shard in range(shards):
+      queue_worker(shard, name="fanout-%s-shard-%d" % (window, shard))
+    logging.info("fanned out %d poll workers" % shards)
+    self.response.out.write("fanned out %d workers" % shards)
+
+
+class FeedPollerBackfill(webapp.RequestHandler):
+  """Move streams stored before feed sources onto a shared source"""
+  def get(self):
+    if queue_backfill():
+      self.response.out.write("source backfill started")
+    else:
+      self.response.out.write("source backfill already queued")
+
+
+# stored items carried over to a new source, enough to cover a feed's current entries
+BACKFILL_ITEMS = 100
+
+def queue_backfill():
+  """Start the source backfill unless it already ran, returns False if it did"""
+  try:
+    deferred.defer(backfill_sources, _name="backfill-sources")
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    return False
+  return True
+
+
+def attach_source(stream):
+  """Point a stream stored before sources at the source for its url.
+
+  The first stream of a source hands its latest items over, so the first
+  poll of the source finds them stored instead of new.  Everything the
+  stream already had counts as delivered.  Returns the updated stream.
+  """
+  source, needs_poll = FeedSource.follow(stream.url, stream.key())
+  if needs_poll:
+    items = stream.items.order('-published').fetch(BACKFILL_ITEMS)
+    if len(items) > 0:
+      # oldest first, so the copies are numbered in the order they were posted
+      items.reverse()
+      FeedItem.store(source, [item.copy_for_source(source) for item in items])
+  delivered_seq = ItemSequence.current(source.key())
+
+  def txn():
+    fresh = db.get(stream.key())
+    if fresh.source_key() is None:
+      # unless another request got there first
+      fresh.source = source
+      fresh.delivered_seq = delivered_seq
+      fresh.put()
+    return fresh
+  fresh = db.run_in_transaction(txn)
+  fresh.invalidate_cache()
+  return fresh
+
+
+def backfill_sources(cursor=None, batch_size=20):
+  """Attach streams without a source to the source for their url, in batches"""
+  query = FeedStream.all()
+  if cursor is not None:
+    query.with_cursor(cursor)
+  streams = query.fetch(batch_size)
+  for stream in streams:
+    if stream.deleted or stream.source_key() is not None or not stream.url:
+      continue
+    if stream.current_status() != FeedStream.STATUS_ACTIVE:
+      continue
+    attach_source(stream)
+  if len(streams) == batch_size:
+    deferred.defer(backfill_sources, query.cursor(), batch_size)
+  else:
+    logging.info("source backfill finished")
+
+
+def purge_source_items(source_key, batch_size=500):
+  """Delete the items of a source nobody follows any more, in batches.
+
+  Items are children of the source, so each batch is deleted in a
+  transaction that checks the source is still idle: a stream that starts
+  following it meanwhile keeps its items.
+  """
+  def txn():
+    source = db.get(source_key)
+    if source is None or source.active:
+      return 0
+    keys = FeedItem.all(keys_only=True).ancestor(source_key).fetch(batch_size)
+    db.delete(keys)
+    return len(keys)
+  if db.run_in_transaction(txn) == batch_size:
+    deferred.defer(purge_source_items, source_key, batch_size)
+  else:
+    logging.info("items of source %s purged" % source_key.name())
+
+
+def reshard_sources(cursor=None, batch_size=100):
+  """Move sources onto the shard they belong to under the current shard count, in batches"""
+  query = FeedSource.all(keys_only=True)
+  if cursor is not None:
+    query.with_cursor(cursor)
+  keys = query.fetch(batch_size)
+  shards = FeedSource.shard_count()
+  def txn(key):
+    source = db.get(key)
+    shard = FeedSource.shard_for(key.name())
+    if source is not None and source.shard != shard:
+      source.shard = shard
+      source.put()
+  for key in keys:
+    db.run_in_transaction(txn, key)
+  if len(keys) == batch_size:
+    deferred.defer(reshard_sources, query.cursor(), batch_size)
+  else:
+    logging.info("sources spread over %d shards" % shards)
+
+
+def queue_reshard():
+  """Reshard now, and again once every instance has seen the new shard count"""
+  deferred.defer(reshard_sources)
+  deferred.defer(reshard_sources, _countdown=Configuration.CACHE_TIME.seconds + 60)
 
 
 class FeedPollerSwitch(webapp.RequestHandler):
@@ -166,7 +462,9 @@ def main():
   logging.getLogger().setLevel(logging.DEBUG)
   application = webapp.WSGIApplication([
           (r'/feedpoller/tasks/poll', FeedPoller),
-          (r'/feedpoller/toggle', FeedPollerSwitch)
+          (r'/feedpoller/tasks/fanout', FeedPollerFanout),
+          (r'/feedpoller/toggle', FeedPollerSwitch),
+          (r'/feedpoller/backfill', FeedPollerBackfill)
           ], debug=True)
   wsgiref.handlers.CGIHandler().run(application)
 
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+#
+
+"""Concurrent feed fetching
+
+Issues conditional GETs for a batch of feeds as asynchronous urlfetch
+RPCs, so fetching a batch takes about as long as its slowest feed
+instead of the sum of all of them.  Completed responses are handed back
+as file-like resources that feedparser.parse accepts directly.
+
+A HostLimiter keeps every instance polite to hosts that serve many of our
+feeds: requests over a host's budget are handed back as deferred instead
+of being made.
+"""
+
+import calendar
+import logging
+import time
+import urlparse
+import zlib
+
+try:
+  from cStringIO import StringIO
+except ImportError:
+  from StringIO import StringIO
+
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+
+from lib import feedfinder
+from lib import feedparser
+
+_WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+_MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+
+def format_http_date(dt):
+  """Format a UTC datetime as an RFC 1123 date, independent of the locale"""
+  return '%s, %02d %s %04d %02d:%02d:%02d GMT' % (_WEEKDAYS[dt.weekday()], dt.day,
+      _MONTHS[dt.month - 1], dt.year, dt.hour, dt.minute, dt.second)
+
+
+class FetchRequest(object):
+  """A single conditional GET, or one for just the first max_bytes of a URL"""
+  def __init__(self, url, etag=None, modified=None, key=None, max_bytes=None):
+    self.url = url
+    self.etag = etag
+    self.modified = modified # datetime in UTC
+    self.key = key
+    self.max_bytes = max_bytes
+
+  def headers(self):
+    headers = {'User-Agent': feedparser.USER_AGENT}
+    if self.max_bytes:
+      headers['Range'] = 'bytes=0-%d' % (self.max_bytes - 1)
+    else:
+      headers['Accept-Encoding'] = 'gzip, deflate'
+      headers['A-IM'] = 'feed' # RFC 3229 support
+    if feedparser.ACCEPT_HEADER:
+      headers['Accept'] = feedparser.ACCEPT_HEADER
+    if self.etag:
+      headers['If-None-Match'] = self.etag
+    if self.modified:
+      headers['If-Modified-Since'] = format_http_date(self.modified)
+    return headers
+
+
+class FetchResult(object):
+  """The outcome of a FetchRequest, including how long it took"""
+  def __init__(self, request):
+    self.request = request
+    self.url = request.url
+    self.final_url = request.url
+    self.status_code = None
+    self.headers = {}
+    self.content = ''
+    self.error = None
+    self.deferred = False # turned away by the host limiter, nothing was fetched
+    self.started = None
+    self.elapsed = None
+
+  def to_resource(self):
+    """Wrap the response so it can be passed straight to feedparser.parse"""
+    return _FetchedResource(self)
+
+  def freshness(self):
+    """Seconds the response says it stays fresh, from Cache-Control or Expires.
+
+    None when the server gives no hint, or asks to revalidate every time.
+    """
+    for directive in self.headers.get('cache-control', '').lower().split(','):
+      name, sep, value = directive.strip().partition('=')
+      if name in ('no-cache', 'no-store'):
+        return None
+      if name == 'max-age' and value.strip('"').isdigit():
+        return int(value.strip('"'))
+    expires = self.headers.get('expires')
+    if expires:
+      # count from the server's clock so skew between us doesn't matter
+      now = _header_time(self.headers.get('date', '')) or time.time()
+      expires = _header_time(expires)
+      if expires is None:
+        # an invalid date means already expired
+        return 0
+      return max(int(expires - now), 0)
+    return None
+
+  def retry_after(self):
+    """Seconds a 429 or 503 response asks us to wait, None without a hint"""
+    value = self.headers.get('retry-after', '').strip()
+    if self.status_code not in (429, 503) or not value:
+      return None
+    if value.isdigit():
+      return int(value)
+    when = _header_time(value)
+    if when is None:
+      return None
+    return max(int(when - time.time()), 0)
+
+
+def _header_time(value):
+  """Seconds since the epoch of an HTTP date header, None if it doesn't parse"""
+  parsed = feedparser._parse_date(value)
+  if parsed is None:
+    return None
+  return calendar.timegm(parsed)
+
+
+class _ResponseHeaders(dict):
+  """Lower cased header dict with the bits of mimetools.Message feedparser uses"""
+  def __init__(self, headers):
+    dict.__init__(self)
+    for name, value in headers.items():
+      self[name.lower()] = value
+    self.dict = self
+
+  def getheader(self, name, default=None):
+    return self.get(name.lower(), default)
+
+
+class _FetchedResource(object):
+  """File-like stand in for the urllib2 response feedparser expects"""
+  def __init__(self, result):
+    self._data = StringIO(result.content or '')
+    self.headers = _ResponseHeaders(result.headers)
+    self.url = result.final_url
+    self.status = result.status_code
+
+  def read(self, *args):
+    return self._data.read(*args)
+
+  def info(self):
+    return self.headers
+
+  def close(self):
+    self._data.close()
+
+
+def url_host(url):
+  return urlparse.urlsplit(url)[1].lower()
+
+
+class HostLimiter(object):
+  """Per host request budget shared by every instance through memcache.
+
+  A host gets rate requests per second and at most concurrency requests in
+  flight.  The rate budget is a counter per host and second, a token bucket
+  that refills every second.  Counters memcache loses only make us more
+  permissive, never stuck.
+  """
+  # in flight counters outlive any fetch deadline, then leaked counts go away
+  IN_FLIGHT_TIME = 60
+  # compare and set attempts on a contended in flight counter before calling the host busy
+  CAS_RETRIES = 5
+
+  def __init__(self, rate=2, concurrency=4, namespace='hostlimit'):
+    self.rate = rate
+    self.concurrency = concurrency
+    self.namespace = namespace
+
+  def _in_flight_key(self, host):
+    return '%s_flight_%s' % (self.namespace, host)
+
+  def acquire(self, url):
+    """Take a request from the host's budget, False when it has none left"""
+    host = url_host(url)
+    if not host:
+      return True
+    if not self._take_in_flight(host):
+      return False
+    # a request turned away for concurrency doesn't use up the rate budget
+    rate_key = '%s_rate_%s_%d' % (self.namespace, host, int(time.time()))
+    memcache.add(rate_key, 0, time=2)
+    count = memcache.incr(rate_key)
+    if count is not None and count > self.rate:
+      self.release(url)
+      return False
+    return True
+
+  def _take_in_flight(self, host):
+    """Count one more request in flight unless the host is at its limit.
+
+    Every slot taken writes the counter again, which pushes its expiry
+    out, so a busy host's count never lapses while requests are running.
+    """
+    client = memcache.Client()
+    flight_key = self._in_flight_key(host)
+    for i in range(self.CAS_RETRIES):
+      count = client.gets(flight_key)
+      if count is None:
+        if client.add(flight_key, 1, time=self.IN_FLIGHT_TIME):
+          return True
+      elif count >= self.concurrency:
+        return False
+      elif client.cas(flight_key, count + 1, time=self.IN_FLIGHT_TIME):
+        return True
+    return False
+
+  def release(self, url):
+    """Hand back the in flight slot of a finished request"""
+    host = url_host(url)
+    if host:
+      memcache.decr(self._in_flight_key(host))
+
+
+def interleave_hosts(items, url=lambda item: item.url):
+  """Reorder items round robin by host, so a window of requests spreads over many hosts"""
+  hosts = []
+  by_host = {}
+  for item in items:
+    host = url_host(url(item))
+    if host not in by_host:
+      by_host[host] = []
+      hosts.append(host)
+    by_host[host].append(item)
+  ordered = []
+  for i in range(max([len(queue) for queue in by_host.values()] or [0])):
+    for host in hosts:
+      if i < len(by_host[host]):
+        ordered.append(by_host[host][i])
+  return ordered
+
+
+class FeedFetcher(object):
+  """Fetch many feeds at once, at most max_concurrent RPCs in flight.
+
+  Bodies over max_body bytes, before or after decompression, are dropped
+  with a feedparser.BodyTooLarge error.
+  """
+  def __init__(self, deadline=10, max_concurrent=10, limiter=None, max_body=None):
+    self.deadline = deadline
+    self.max_concurrent = max(max_concurrent, 1)
+    self.limiter = limiter
+    if max_body is None:
+      max_body = feedparser.MAX_BODY_SIZE
+    self.max_body = max_body
+
+  def fetch(self, requests, patience=0):
+    """Fetch every request, returning a FetchResult for each, in order.
+
+    Requests to the same host are spread out over the windows.  Requests
+    the limiter turns away are retried once a second for up to patience
+    seconds and come back deferred after that.
+    """
+    results = [FetchResult(request) for request in requests]
+    give_up = time.time() + patience
+    pending = interleave_hosts(results)
+    while True:
+      for start in range(0, len(pending), self.max_concurrent):
+        self._fetch_window(pending[start:start + self.max_concurrent])
+      pending = [result for result in pending if result.deferred]
+      if len(pending) == 0 or time.time() + 1 > give_up:
+        break
+      time.sleep(1)
+    return results
+
+  def _fetch_window(self, window):
+    rpcs = []
+    acquired = []
+    for result in window:
+      result.deferred = False
+      if self.limiter is not None:
+        if not self.limiter.acquire(result.url):
+          result.deferred = True
+          continue
+        acquired.append(result)
+      rpc = self._start(result)
+      if rpc is not None:
+        rpcs.append(rpc)
+    for rpc in rpcs:
+      rpc.wait()
+    for result in acquired:
+      self.limiter.release(result.url)
+
+  def _start(self, result):
+    rpc = urlfetch.create_rpc(deadline=self.deadline)
+    rpc.callback = lambda: self._complete(rpc, result)
+    result.started = time.time()
+    try:
+      urlfetch.make_fetch_call(rpc, result.url, headers=result.request.headers())
+    except Exception, e:
+      result.error = e
+      result.elapsed = time.time() - result.started
+      return None
+    return rpc
+
+  def _complete(self, rpc, result):
+    result.elapsed = time.time() - result.started
+    try:
+      response = rpc.get_result()
+    except Exception, e:
+      logging.warn("fetch of %s failed after %.3fs: %r" % (result.url, result.elapsed, e))
+      result.error = e
+      return
+    result.status_code = response.status_code
+    result.headers = dict([(name.lower(), value) for name, value in response.headers.items()])
+    if self.max_body and len(response.content or '') > self.max_body:
+      result.error = feedparser.BodyTooLarge('%s sent more than %d bytes' % (result.url, self.max_body))
+      logging.warn("dropped oversized response of %s" % result.url)
+      return
+    result.content = response.content
+    result.final_url = getattr(response, 'final_url', None) or result.url
+    self._decompress(result)
+    logging.debug("fetched %s (%s) in %.3fs" % (result.url, result.status_code, result.elapsed))
+
+  def _decompress(self, result):
+    """Undo any content encoding, urlfetch may already have done it for us"""
+    encoding = result.headers.get('content-encoding', '')
+    if not encoding or not result.content:
+      return
+    try:
+      if encoding == 'gzip' and result.content[:2] == '\x1f\x8b':
+        if result.status_code == 206:
+          # a partial body is a truncated stream, take what inflates, up to max_body
+          decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+          content = decompressor.decompress(result.content, self.max_body and self.max_body + 1 or 0)
+          if decompressor.unconsumed_tail or (self.max_body and len(content) > self.max_body):
+            raise feedparser.BodyTooLarge('%s inflates to more than %d bytes' % (result.url, self.max_body))
+          result.content = content
+        else:
+          result.content = self._inflate(result.content, encoding)
+      elif encoding == 'deflate':
+        result.content = self._inflate(result.content, encoding)
+    except Exception, e:
+      result.error = e
+      return
+    del result.headers['content-encoding']
+
+  def _inflate(self, content, encoding):
+    """Decompress in chunks, giving up as soon as the body passes max_body"""
+    return feedparser._readBody(StringIO(content), encoding, self.max_body)
+
+
+class FeedFinderGatekeeper(feedfinder.URLGatekeeper):
+  """feedfinder gatekeeper that checks candidate feeds with concurrent urlfetch RPCs
+
+  feedfinder's own gatekeeper probes with threads, which run one after the
+  other on App Engine.
+  """
+  def __init__(self, deadline=10, rpcache=None, limiter=None):
+    feedfinder.URLGatekeeper.__init__(self, rpcache)
+    self.deadline = deadline
+    self.limiter = limiter
+
+  def sniff(self, url, size=feedfinder.SNIFF_SIZE, check=True):
+    if check and not self.can_fetch(url):
+      return ''
+    return self._sniff([url], size, self.deadline)[0]
+
+  def sniffAll(self, urls, size=feedfinder.SNIFF_SIZE, timeout=None):
+    deadline = self.deadline
+    if timeout is not None:
+      deadline = max(min(deadline, timeout), 1)
+    allowed = [url for url in urls if self.can_fetch(url)]
+    data = dict(zip(allowed, self._sniff(allowed, size, deadline)))
+    return [data.get(url, '') for url in urls]
+
+  def _sniff(self, urls, size, deadline):
+    fetcher = FeedFetcher(deadline=deadline, max_concurrent=max(len(urls), 1), limiter=self.limiter)
+    data = []
+    # candidates mostly share the site's host, wait a while for its budget rather than skip them
+    for result in fetcher.fetch([FetchRequest(url, max_bytes=size) for url in urls], patience=deadline / 2):
+      if result.error is None and result.status_code in (200, 206):
+        data.append(result.content[:size])
+      else:
+        data.append('')
+    return data
@@ -46,7 +46,13 @@ Also Jason Diamond, Brian Lalor for bug reporting and patches"""
 
 _debug = 0
 
-import sgmllib, urllib, urlparse, re, sys, robotparser
+import sgmllib, urllib, urllib2, urlparse, re, sys, robotparser, time, Queue
+
+# how much of a candidate URL is downloaded to decide whether it is a feed
+SNIFF_SIZE = 4096
+# candidates checked at once, and how long all the checking may take
+PROBE_CONCURRENCY = 4
+PROBE_DEADLINE = 20
 
 import threading
 class TimeoutError(Exception): pass
@@ -98,8 +104,11 @@ def _debuglog(message):
     
 class URLGatekeeper:
     """a class to track robots.txt rules across multiple servers"""
-    def __init__(self):
-        self.rpcache = {} # a dictionary of RobotFileParser objects, by domain
+    def __init__(self, rpcache=None):
+        # RobotFileParser objects by domain, anything with get and item assignment will do
+        if rpcache is None:
+            rpcache = {}
+        self.rpcache = rpcache
         self.urlopener = urllib.FancyURLopener()
         self.urlopener.version = "feedfinder/" + __version__ + " " + self.urlopener.version + " +http://www.aaronsw.com/2002/feedfinder/"
         _debuglog(self.urlopener.version)
@@ -109,8 +118,9 @@ class URLGatekeeper:
         
     def _getrp(self, url):
         protocol, domain = urlparse.urlparse(url)[:2]
-        if self.rpcache.has_key(domain):
-            return self.rpcache[domain]
+        rp = self.rpcache.get(domain)
+        if rp is not None:
+            return rp
         baseurl = '%s://%s' % (protocol, domain)
         robotsurl = urlparse.urljoin(baseurl, 'robots.txt')
         _debuglog('fetching %s' % robotsurl)
@@ -136,8 +146,61 @@ class URLGatekeeper:
         except:
             return ''
 
+    @timelimit(10)
+    def sniff(self, url, size=SNIFF_SIZE, check=True):
+        """the first size bytes of url, asking the server for just those"""
+        if check and not self.can_fetch(url): return ''
+        headers = {'User-agent': self.urlopener.version,
+                   'Range': 'bytes=0-%d' % (size - 1)}
+        try:
+            f = urllib2.urlopen(urllib2.Request(url, headers=headers))
+            try:
+                # servers that ignore Range send everything, stop reading early
+                return f.read(size)
+            finally:
+                f.close()
+        except:
+            return ''
+
+    def sniffAll(self, urls, size=SNIFF_SIZE, timeout=None):
+        """sniff every url at once, returning the data in the same order
+
+        urls that haven't answered within timeout seconds come back as ''"""
+        results = [''] * len(urls)
+        queue = Queue.Queue()
+        for i in range(len(urls)):
+            queue.put(i)
+        def work():
+            while 1:
+                try:
+                    i = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[i] = self.sniff(urls[i], size)
+                except:
+                    pass
+        workers = []
+        for n in range(min(len(urls), PROBE_CONCURRENCY)):
+            worker = threading.Thread(target=work)
+            worker.setDaemon(True)
+            worker.start()
+            workers.append(worker)
+        started = time.time()
+        for worker in workers:
+            if timeout is None:
+                worker.join()
+            else:
+                worker.join(max(timeout - (time.time() - started), 0))
+        return results[:]
+
 _gatekeeper = URLGatekeeper()
 
+def setGatekeeper(gatekeeper):
+    """fetch through gatekeeper from now on, e.g. one built on another HTTP client"""
+    global _gatekeeper
+    _gatekeeper = gatekeeper
+
 class BaseParser(sgmllib.SGMLParser):
     def __init__(self, baseuri):
         sgmllib.SGMLParser.__init__(self)
@@ -219,18 +282,97 @@ def tryBrokenRedirect(data):
         newuris = r_brokenRedirect.findall(data)
         if newuris: return newuris[0].strip()
 
+def sniffRootElement(data):
+    """lowercased name of the first element in data, None if there isn't a whole one"""
+    i = 0
+    n = len(data)
+    while 1:
+        i = data.find('<', i)
+        if i == -1 or i + 1 >= n: return None
+        c = data[i+1]
+        if c == '?':
+            end = data.find('?>', i + 2)
+            if end == -1: return None
+            i = end + 2
+        elif c == '!':
+            if data.startswith('<!--', i):
+                end = data.find('-->', i + 4)
+                if end == -1: return None
+                i = end + 3
+            else:
+                # doctype, skipping any internal subset
+                end = data.find('>', i + 2)
+                subset = data.find('[', i + 2)
+                if subset != -1 and (end == -1 or subset < end):
+                    end = data.find(']', subset)
+                    if end != -1: end = data.find('>', end)
+                if end == -1: return None
+                i = end + 1
+        else:
+            j = i + 1
+            while j < n and data[j] not in ' \t\r\n/>':
+                j += 1
+            if j >= n: return None
+            return data[i+1:j].lower()
+
 def couldBeFeedData(data):
+    # the root element gives it away within the first few KB
+    data = data[:SNIFF_SIZE]
+    root = sniffRootElement(data)
+    if root is not None:
+        if root.split(':')[-1] in ('rss', 'rdf', 'feed'): return 1
+        if root == 'html': return 0
+    # odd prologue (server warnings and the like), look for the tags instead
     data = data.lower()
-    if data.count('<html'): return 0
-    return data.count('<rss') + data.count('<rdf') + data.count('<feed')
+    if data.find('<html') != -1: return 0
+    if data.find('<rss') != -1 or data.find('<rdf') != -1 or data.find('<feed') != -1: return 1
+    return 0
 
 def isFeed(uri):
     _debuglog('seeing if %s is a feed' % uri)
     protocol = urlparse.urlparse(uri)
     if protocol[0] not in ('http', 'https'): return 0
-    data = _gatekeeper.get(uri)
+    data = _gatekeeper.sniff(uri)
     return couldBeFeedData(data)
 
+def probeFeeds(tiers, all=False, first=False, deadline=PROBE_DEADLINE):
+    """Check candidate URLs for feeds, PROBE_CONCURRENCY at a time
+
+    tiers is a list of candidate lists, most likely ones first.  Unless all
+    is set this stops at the first tier with a feed and returns that tier's
+    feeds, or just the first feed found if first is set.  Checking stops
+    when deadline seconds have gone by."""
+    started = time.time()
+    candidates = []
+    seen = {}
+    for rank in range(len(tiers)):
+        for url in tiers[rank]:
+            if seen.has_key(url): continue
+            seen[url] = 1
+            candidates.append((rank, url))
+    found = []
+    i = 0
+    while i < len(candidates):
+        remaining = deadline - (time.time() - started)
+        if remaining <= 0:
+            _debuglog('out of time with %s candidates left' % (len(candidates) - i))
+            break
+        window = candidates[i:i + PROBE_CONCURRENCY]
+        i += len(window)
+        data = _gatekeeper.sniffAll([url for rank, url in window], timeout=remaining)
+        for n in range(len(window)):
+            if couldBeFeedData(data[n]):
+                found.append(window[n])
+        if found and not all:
+            # candidates are checked in rank order, so nothing left beats these
+            if first: return [found[0][1]]
+            best = found[0][0]
+            if i >= len(candidates) or candidates[i][0] > best:
+                break
+    if found and not all:
+        found = [(rank, url) for rank, url in found if rank == found[0][0]]
+    return [url for rank, url in found]
+
 def sortFeeds(feed1Info, feed2Info):
     return cmp(feed2Info['headlines_rank'], feed1Info['headlines_rank'])
 
@@ -247,7 +389,7 @@ def getFeedsFromSyndic8(uri):
         pass
     return feeds
     
-def feeds(uri, all=False, querySyndic8=False, _recurs=None):
+def feeds(uri, all=False, querySyndic8=False, _recurs=None, first=False):
     if _recurs is None: _recurs = [uri]
     fulluri = makeFullURI(uri)
     try:
@@ -260,58 +402,51 @@ def feeds(uri, all=False, querySyndic8=False, _recurs=None):
     newuri = tryBrokenRedirect(data)
     if newuri and newuri not in _recurs:
         _recurs.append(newuri)
-        return feeds(newuri, all=all, querySyndic8=querySyndic8, _recurs=_recurs)
-    # nope, it's a page, try LINK tags first
+        return feeds(newuri, all=all, querySyndic8=querySyndic8, _recurs=_recurs, first=first)
+    # nope, it's a page, LINK tags are the best bet
     _debuglog('looking for LINK tags')
     try:
-        outfeeds = getLinks(data, fulluri)
+        linkfeeds = getLinks(data, fulluri)
     except:
-        outfeeds = []
-    _debuglog('found %s feeds through LINK tags' % len(outfeeds))
-    outfeeds = filter(isFeed, outfeeds)
-    if all or not outfeeds:
-        # no LINK tags, look for regular <A> links that point to feeds
-        _debuglog('no LINK tags, looking at A tags')
-        try:
-            links = getALinks(data, fulluri)
-        except:
-            links = []
-        locallinks = getLocalLinks(links, fulluri)
-        # look for obvious feed links on the same server
-        outfeeds.extend(filter(isFeed, filter(isFeedLink, locallinks)))
-        if all or not outfeeds:
-            # look harder for feed links on the same server
-            outfeeds.extend(filter(isFeed, filter(isXMLRelatedLink, locallinks)))
-        if all or not outfeeds:
-            # look for obvious feed links on another server
-            outfeeds.extend(filter(isFeed, filter(isFeedLink, links)))
-        if all or not outfeeds:
-            # look harder for feed links on another server
-            outfeeds.extend(filter(isFeed, filter(isXMLRelatedLink, links)))
-    if all or not outfeeds:
-        _debuglog('no A tags, guessing')
-        suffixes = [ # filenames used by popular software:
-          'atom.xml', # blogger, TypePad
-          'index.atom', # MT, apparently
-          'index.rdf', # MT
-          'rss.xml', # Dave Winer/Manila
-          'index.xml', # MT
-          'index.rss' # Slash
-        ]
-        outfeeds.extend(filter(isFeed, [urlparse.urljoin(fulluri, x) for x in suffixes]))
+        linkfeeds = []
+    _debuglog('found %s feeds through LINK tags' % len(linkfeeds))
+    # then regular <A> links that point to feeds
+    try:
+        links = getALinks(data, fulluri)
+    except:
+        links = []
+    locallinks = getLocalLinks(links, fulluri)
+    suffixes = [ # filenames used by popular software:
+      'atom.xml', # blogger, TypePad
+      'index.atom', # MT, apparently
+      'index.rdf', # MT
+      'rss.xml', # Dave Winer/Manila
+      'index.xml', # MT
+      'index.rss' # Slash
+    ]
+    tiers = [linkfeeds,
+             # obvious feed links on the same server
+             filter(isFeedLink, locallinks),
+             # less obvious feed links on the same server
+             filter(isXMLRelatedLink, locallinks),
+             # obvious feed links on another server
+             filter(isFeedLink, links),
+             # less obvious feed links on another server
+             filter(isXMLRelatedLink, links),
+             # guesses
+             [urlparse.urljoin(fulluri, x) for x in suffixes]]
+    outfeeds = probeFeeds(tiers, all=all, first=first)
     if (all or not outfeeds) and querySyndic8:
         # still no luck, search Syndic8 for feeds (requires xmlrpclib)
         _debuglog('still no luck, searching Syndic8')
-        outfeeds.extend(getFeedsFromSyndic8(uri))
-    if hasattr(__builtins__, 'set') or __builtins__.has_key('set'):
-        outfeeds = list(set(outfeeds))
+        outfeeds.extend([f for f in getFeedsFromSyndic8(uri) if f not in outfeeds])
     return outfeeds
 
 getFeeds = feeds # backwards-compatibility
 
 def feed(uri):
     #todo: give preference to certain feed formats
-    feedlist = feeds(uri)
+    feedlist = feeds(uri, first=True)
     if feedlist:
         return feedlist[0]
     else:
@@ -65,12 +65,21 @@ TIDY_MARKUP = 0
 # if TIDY_MARKUP = 1
 PREFERRED_TIDY_INTERFACES = ["uTidy", "mxTidy"]
 
+# Largest feed body parse() will read, after decompression.  Bigger feeds are
+# abandoned as soon as they pass it, with bozo_exception set to BodyTooLarge.
+# Set this to 0 to read bodies of any size.
+MAX_BODY_SIZE = 2 * 1024 * 1024
+
 # ---------- required modules (should come with any Python distribution) ----------
 import sgmllib, re, sys, copy, urlparse, time, rfc822, types, cgi, urllib, urllib2
 try:
     from cStringIO import StringIO as _StringIO
 except:
     from StringIO import StringIO as _StringIO
+try:
+    from hashlib import sha1 as _sha1
+except ImportError:
+    from sha import new as _sha1
 
 # ---------- optional modules (feedparser will work without these, but with reduced functionality) ----------
 
@@ -134,6 +143,7 @@ class CharacterEncodingOverride(ThingsNobodyCaresAboutButMe): pass
 class CharacterEncodingUnknown(ThingsNobodyCaresAboutButMe): pass
 class NonXMLContentType(ThingsNobodyCaresAboutButMe): pass
 class UndeclaredNamespace(Exception): pass
+class BodyTooLarge(Exception): pass
 
 sgmllib.tagfind = re.compile('[a-zA-Z][-_.:a-zA-Z0-9]*')
 sgmllib.special = re.compile('<!')
@@ -169,6 +179,39 @@ except NameError:
             rc[k] = v
         return rc
 
+class _LRUCache:
+    '''Small bounded mapping that forgets the least recently used keys first'''
+    def __init__(self, size):
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        self._data = {}
+        self._tick = 0
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        self._tick += 1
+        entry[1] = self._tick
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        if len(self._data) >= self.size and not self._data.has_key(key):
+            # evict the oldest quarter at once so inserts stay cheap
+            ticks = [entry[1] for entry in self._data.values()]
+            ticks.sort()
+            cutoff = ticks[len(ticks) / 4]
+            for k, entry in self._data.items():
+                if entry[1] <= cutoff:
+                    del self._data[k]
+        self._tick += 1
+        self._data[key] = [value, self._tick]
+
+    def __len__(self):
+        return len(self._data)
+
 class FeedParserDict(UserDict):
     keymap = {'channel': 'feed',
               'items': 'entries',
@@ -185,32 +228,32 @@ class FeedParserDict(UserDict):
               'copyright_detail': 'rights_detail',
               'tagline': 'subtitle',
               'tagline_detail': 'subtitle_detail'}
+    # keymap resolved once (see _resolveKeymap below) so every access is a
+    # single dict lookup: alias -> key to store under, and alias -> keys
+    # to try in order when reading
+    _setkeys = {}
+    _getkeys = {}
+
     def __getitem__(self, key):
+        getkeys = self._getkeys.get(key)
+        if getkeys is None:
+            return UserDict.__getitem__(self, key)
         if key == 'category':
             return UserDict.__getitem__(self, 'tags')[0]['term']
         if key == 'categories':
             return [(tag['scheme'], tag['term']) for tag in UserDict.__getitem__(self, 'tags')]
-        realkey = self.keymap.get(key, key)
-        if type(realkey) == types.ListType:
-            for k in realkey:
-                if UserDict.has_key(self, k):
-                    return UserDict.__getitem__(self, k)
-        if UserDict.has_key(self, key):
-            return UserDict.__getitem__(self, key)
-        return UserDict.__getitem__(self, realkey)
+        for k in getkeys:
+            if UserDict.has_key(self, k):
+                return UserDict.__getitem__(self, k)
+        raise KeyError, key
 
     def __setitem__(self, key, value):
-        for k in self.keymap.keys():
-            if key == k:
-                key = self.keymap[k]
-                if type(key) == types.ListType:
-                    key = key[0]
-        return UserDict.__setitem__(self, key, value)
+        return UserDict.__setitem__(self, self._setkeys.get(key, key), value)
 
     def get(self, key, default=None):
-        if self.has_key(key):
-            return self[key]
-        else:
+        try:
+            return self.__getitem__(key)
+        except (KeyError, IndexError):
             return default
 
     def setdefault(self, key, value):
@@ -219,16 +262,17 @@ class FeedParserDict(UserDict):
         return self[key]
         
     def has_key(self, key):
+        getkeys = self._getkeys.get(key)
+        if getkeys is None:
+            return UserDict.has_key(self, key) or self.__dict__.has_key(key)
         try:
-            return hasattr(self, key) or UserDict.has_key(self, key)
-        except AttributeError:
+            self.__getitem__(key)
+            return True
+        except (KeyError, IndexError):
             return False
         
     def __getattr__(self, key):
-        try:
-            return self.__dict__[key]
-        except KeyError:
-            pass
+        # only called once normal attribute lookup has failed
         try:
             assert not key.startswith('_')
             return self.__getitem__(key)
@@ -241,8 +285,20 @@ class FeedParserDict(UserDict):
         else:
             return self.__setitem__(key, value)
 
-    def __contains__(self, key):
-        return self.has_key(key)
+    __contains__ = has_key
+
+def _resolveKeymap(keymap):
+    setkeys = {}
+    getkeys = {'category': (), 'categories': ()}
+    for alias, realkey in keymap.items():
+        if type(realkey) == types.ListType:
+            setkeys[alias] = realkey[0]
+            getkeys[alias] = tuple(realkey) + (alias,)
+        else:
+            setkeys[alias] = realkey
+            getkeys[alias] = (alias, realkey)
+    return setkeys, getkeys
+FeedParserDict._setkeys, FeedParserDict._getkeys = _resolveKeymap(FeedParserDict.keymap)
 
 def zopeCompatibilityHack():
     global FeedParserDict
@@ -349,9 +405,10 @@ class _FeedParserMixin:
 }
     _matchnamespaces = {}
 
-    can_be_relative_uri = ['link', 'id', 'wfw_comment', 'wfw_commentrss', 'docs', 'url', 'href', 'comments', 'license', 'icon', 'logo']
-    can_contain_relative_uris = ['content', 'title', 'summary', 'info', 'tagline', 'subtitle', 'copyright', 'rights', 'description']
-    can_contain_dangerous_markup = ['content', 'title', 'summary', 'info', 'tagline', 'subtitle', 'copyright', 'rights', 'description']
+    can_be_relative_uri = frozenset(['link', 'id', 'wfw_comment', 'wfw_commentrss', 'docs', 'url', 'href', 'comments', 'license', 'icon', 'logo'])
+    can_contain_relative_uris = frozenset(['content', 'title', 'summary', 'info', 'tagline', 'subtitle', 'copyright', 'rights', 'description'])
+    can_contain_dangerous_markup = frozenset(['content', 'title', 'summary', 'info', 'tagline', 'subtitle', 'copyright', 'rights', 'description'])
+    fields = None # entry keys to keep, see _projectFields; None keeps everything
     html_types = ['text/html', 'application/xhtml+xml']
     
     def __init__(self, baseuri=None, baselang=None, encoding='utf-8'):
@@ -385,6 +442,7 @@ class _FeedParserMixin:
         self.langstack = []
         self.baseuri = baseuri or ''
         self.lang = baselang or None
+        self._date_handler = None # last date handler that worked for this feed
         if baselang:
             self.feeddata['language'] = baselang
 
@@ -598,6 +656,13 @@ class _FeedParserMixin:
     def push(self, element, expectingText):
         self.elementstack.append([element, expectingText, []])
 
+    def _isWanted(self, key):
+        if self.fields is None or not self.inentry or self.insource:
+            return 1
+        if key == 'description':
+            key = 'summary'
+        return self.fields.has_key(key)
+
     def pop(self, element, stripWhitespace=1):
         if not self.elementstack: return
         if self.elementstack[-1][0] != element: return
@@ -608,6 +673,13 @@ class _FeedParserMixin:
             output = output.strip()
         if not expectingText: return output
 
+        # entry elements left out of the projection are still returned to
+        # their end handler, but never stored and only cleaned up when
+        # _end_content is going to copy them to a missing description
+        wanted = self._isWanted(element)
+        clean = wanted or (element == 'content' and self._isWanted('summary') and \
+                           not self._getContext().has_key('description'))
+
         # decode base64 content
         if base64 and self.contentparams.get('base64', 0):
             try:
@@ -635,15 +707,12 @@ class _FeedParserMixin:
         except KeyError:
             pass
 
-        # resolve relative URIs within embedded markup
-        if self.mapContentType(self.contentparams.get('type', 'text/html')) in self.html_types:
-            if element in self.can_contain_relative_uris:
-                output = _resolveRelativeURIs(output, self.baseuri, self.encoding)
-        
-        # sanitize embedded markup
-        if self.mapContentType(self.contentparams.get('type', 'text/html')) in self.html_types:
-            if element in self.can_contain_dangerous_markup:
-                output = _sanitizeHTML(output, self.encoding)
+        # resolve relative URIs within and sanitize embedded markup
+        if clean and self.mapContentType(self.contentparams.get('type', 'text/html')) in self.html_types:
+            resolve = element in self.can_contain_relative_uris
+            sanitize = element in self.can_contain_dangerous_markup
+            if resolve or sanitize:
+                output = _cleanHTML(output, resolve and self.baseuri or None, self.encoding, sanitize)
 
         if self.encoding and type(output) != type(u''):
             try:
@@ -652,7 +721,7 @@ class _FeedParserMixin:
                 pass
 
         # categories/tags/keywords/whatever are handled in _end_category
-        if element == 'category':
+        if element == 'category' or not wanted:
             return output
         
         # store output in appropriate place(s)
@@ -670,7 +739,7 @@ class _FeedParserMixin:
                 if element == 'description':
                     element = 'summary'
                 self.entries[-1][element] = output
-                if self.incontent:
+                if self.incontent and self._isWanted(element + '_detail'):
                     contentparams = copy.deepcopy(self.contentparams)
                     contentparams['value'] = output
                     self.entries[-1][element + '_detail'] = contentparams
@@ -1046,6 +1115,11 @@ class _FeedParserMixin:
         self._sync_author_detail('publisher')
     _end_webmaster = _end_dc_publisher
 
+    def _parse_date(self, dateString):
+        # feeds stick to one date format, so try whatever worked last time first
+        date9tuple, self._date_handler = _parse_date_handler(dateString, self._date_handler)
+        return date9tuple
+
     def _start_published(self, attrsD):
         self.push('published', 1)
     _start_dcterms_issued = _start_published
@@ -1053,7 +1127,7 @@ class _FeedParserMixin:
 
     def _end_published(self):
         value = self.pop('published')
-        self._save('published_parsed', _parse_date(value))
+        self._save('published_parsed', self._parse_date(value))
     _end_dcterms_issued = _end_published
     _end_issued = _end_published
 
@@ -1066,7 +1140,7 @@ class _FeedParserMixin:
 
     def _end_updated(self):
         value = self.pop('updated')
-        parsed_value = _parse_date(value)
+        parsed_value = self._parse_date(value)
         self._save('updated_parsed', parsed_value)
     _end_modified = _end_updated
     _end_dcterms_modified = _end_updated
@@ -1079,14 +1153,14 @@ class _FeedParserMixin:
 
     def _end_created(self):
         value = self.pop('created')
-        self._save('created_parsed', _parse_date(value))
+        self._save('created_parsed', self._parse_date(value))
     _end_dcterms_created = _end_created
 
     def _start_expirationdate(self, attrsD):
         self.push('expired', 1)
 
     def _end_expirationdate(self):
-        self._save('expired_parsed', _parse_date(self.pop('expired')))
+        self._save('expired_parsed', self._parse_date(self.pop('expired')))
 
     def _start_cc_license(self, attrsD):
         self.push('license', 1)
@@ -1411,8 +1485,8 @@ if _XML_AVAILABLE:
             raise exc
 
 class _BaseHTMLProcessor(sgmllib.SGMLParser):
-    elements_no_end_tag = ['area', 'base', 'basefont', 'br', 'col', 'frame', 'hr',
-      'img', 'input', 'isindex', 'link', 'meta', 'param']
+    elements_no_end_tag = frozenset(['area', 'base', 'basefont', 'br', 'col', 'frame', 'hr',
+      'img', 'input', 'isindex', 'link', 'meta', 'param'])
     
     def __init__(self, encoding):
         self.encoding = encoding
@@ -1430,10 +1504,12 @@ class _BaseHTMLProcessor(sgmllib.SGMLParser):
         else:
             return '<' + tag + '></' + tag + '>'
         
+    _bogus_decl_sub = re.compile(r'<!((?!DOCTYPE|--|\[))', re.IGNORECASE).sub
+    _shorttag_sub = re.compile(r'<([^<\s]+?)\s*/>').sub
     def feed(self, data):
-        data = re.compile(r'<!((?!DOCTYPE|--|\[))', re.IGNORECASE).sub(r'&lt;!\1', data)
+        data = self._bogus_decl_sub(r'&lt;!\1', data)
         #data = re.sub(r'<(\S+?)\s*?/>', self._shorttag_replace, data) # bug [ 1399464 ] Bad regexp for _shorttag_replace
-        data = re.sub(r'<([^<\s]+?)\s*/>', self._shorttag_replace, data) 
+        data = self._shorttag_sub(self._shorttag_replace, data) 
         data = data.replace('&#39;', "'")
         data = data.replace('&#34;', '"')
         if self.encoding and type(data) == type(u''):
@@ -1550,7 +1626,7 @@ class _LooseFeedParser(_FeedParserMixin, _BaseHTMLProcessor):
         return data
         
 class _RelativeURIResolver(_BaseHTMLProcessor):
-    relative_uris = [('a', 'href'),
+    relative_uris = frozenset([('a', 'href'),
                      ('applet', 'codebase'),
                      ('area', 'href'),
                      ('blockquote', 'cite'),
@@ -1574,7 +1650,7 @@ class _RelativeURIResolver(_BaseHTMLProcessor):
                      ('object', 'data'),
                      ('object', 'usemap'),
                      ('q', 'cite'),
-                     ('script', 'src')]
+                     ('script', 'src')])
 
     def __init__(self, baseuri, encoding):
         _BaseHTMLProcessor.__init__(self, encoding)
@@ -1595,16 +1671,16 @@ def _resolveRelativeURIs(htmlSource, baseURI, encoding):
     return p.output()
 
 class _HTMLSanitizer(_BaseHTMLProcessor):
-    acceptable_elements = ['a', 'abbr', 'acronym', 'address', 'area', 'b', 'big',
+    acceptable_elements = frozenset(['a', 'abbr', 'acronym', 'address', 'area', 'b', 'big',
       'blockquote', 'br', 'button', 'caption', 'center', 'cite', 'code', 'col',
       'colgroup', 'dd', 'del', 'dfn', 'dir', 'div', 'dl', 'dt', 'em', 'fieldset',
       'font', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'input',
       'ins', 'kbd', 'label', 'legend', 'li', 'map', 'menu', 'ol', 'optgroup',
       'option', 'p', 'pre', 'q', 's', 'samp', 'select', 'small', 'span', 'strike',
       'strong', 'sub', 'sup', 'table', 'tbody', 'td', 'textarea', 'tfoot', 'th',
-      'thead', 'tr', 'tt', 'u', 'ul', 'var']
+      'thead', 'tr', 'tt', 'u', 'ul', 'var'])
 
-    acceptable_attributes = ['abbr', 'accept', 'accept-charset', 'accesskey',
+    acceptable_attributes = frozenset(['abbr', 'accept', 'accept-charset', 'accesskey',
       'action', 'align', 'alt', 'axis', 'border', 'cellpadding', 'cellspacing',
       'char', 'charoff', 'charset', 'checked', 'cite', 'class', 'clear', 'cols',
       'colspan', 'color', 'compact', 'coords', 'datetime', 'dir', 'disabled',
@@ -1613,9 +1689,22 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
       'multiple', 'name', 'nohref', 'noshade', 'nowrap', 'prompt', 'readonly',
       'rel', 'rev', 'rows', 'rowspan', 'rules', 'scope', 'selected', 'shape', 'size',
       'span', 'src', 'start', 'summary', 'tabindex', 'target', 'title', 'type',
-      'usemap', 'valign', 'value', 'vspace', 'width']
+      'usemap', 'valign', 'value', 'vspace', 'width'])
+
+    unacceptable_elements_with_end_tag = frozenset(['script', 'applet', 'style'])
 
-    unacceptable_elements_with_end_tag = ['script', 'applet']
+    # attributes holding a URI, which must use one of the acceptable schemes
+    uri_attributes = frozenset(['action', 'cite', 'href', 'longdesc', 'src', 'usemap'])
+    acceptable_uri_schemes = frozenset(['http', 'https', 'ftp', 'mailto', 'news', 'nntp',
+      'feed', 'tag', 'urn', 'irc', 'xmpp', 'webcal'])
+    # browsers ignore whitespace and control characters inside a scheme
+    _uri_noise = re.compile(r'[\s\x00-\x1f]+')
+    _uri_scheme = re.compile(r'^([a-zA-Z][a-zA-Z0-9+.\-]*):')
+
+    def __init__(self, encoding, baseuri=None):
+        _BaseHTMLProcessor.__init__(self, encoding)
+        # resolve relative URIs in the same pass unless baseuri is None
+        self.baseuri = baseuri
 
     def reset(self):
         _BaseHTMLProcessor.reset(self)
@@ -1628,8 +1717,20 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
             return
         attrs = self.normalize_attrs(attrs)
         attrs = [(key, value) for key, value in attrs if key in self.acceptable_attributes]
+        if self.baseuri is not None:
+            relative_uris = _RelativeURIResolver.relative_uris
+            attrs = [(key, ((tag, key) in relative_uris) and _urljoin(self.baseuri, value) or value) for key, value in attrs]
+        attrs = [(key, value) for key, value in attrs if key not in self.uri_attributes or self.acceptable_uri(value)]
+        # values are written back double quoted, a stray quote would open up
+        # a new attribute that nothing gets to sanitize
+        attrs = [(key, value.replace('"', '&quot;')) for key, value in attrs]
         _BaseHTMLProcessor.unknown_starttag(self, tag, attrs)
         
+    def acceptable_uri(self, value):
+        '''Relative URIs and URIs with an acceptable scheme, not javascript: and the like'''
+        match = self._uri_scheme.match(self._uri_noise.sub('', value))
+        return match is None or match.group(1).lower() in self.acceptable_uri_schemes
+
     def unknown_endtag(self, tag):
         if not tag in self.acceptable_elements:
             if tag in self.unacceptable_elements_with_end_tag:
@@ -1647,8 +1748,8 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
         if not self.unacceptablestack:
             _BaseHTMLProcessor.handle_data(self, text)
 
-def _sanitizeHTML(htmlSource, encoding):
-    p = _HTMLSanitizer(encoding)
+def _sanitizeHTML(htmlSource, encoding, baseURI=None):
+    p = _HTMLSanitizer(encoding, baseURI)
     p.feed(htmlSource)
     data = p.output()
     if TIDY_MARKUP:
@@ -1686,6 +1787,27 @@ def _sanitizeHTML(htmlSource, encoding):
     data = data.strip().replace('\r\n', '\n')
     return data
 
+# cleaned markup by content hash; unchanged entries come back on every poll
+_clean_cache = _LRUCache(500)
+
+def _cleanHTML(htmlSource, baseURI, encoding, sanitize=1):
+    '''Resolve relative URIs against baseURI (unless it is None) and, if
+    sanitize is set, sanitize htmlSource, all in a single parsing pass'''
+    if not htmlSource:
+        return htmlSource
+    raw = htmlSource
+    if type(raw) == type(u''):
+        raw = raw.encode('utf-8')
+    key = (_sha1(raw).digest(), type(htmlSource), baseURI, encoding, sanitize)
+    output = _clean_cache.get(key)
+    if output is None:
+        if sanitize:
+            output = _sanitizeHTML(htmlSource, encoding, baseURI)
+        else:
+            output = _resolveRelativeURIs(htmlSource, baseURI, encoding)
+        _clean_cache[key] = output
+    return output
+
 class _FeedURLHandler(urllib2.HTTPDigestAuthHandler, urllib2.HTTPRedirectHandler, urllib2.HTTPDefaultErrorHandler):
     def http_error_default(self, req, fp, code, msg, headers):
         if ((code / 100) == 3) and (code != 304):
@@ -1834,6 +1956,10 @@ _date_handlers = []
 def registerDateHandler(func):
     '''Register a date handler function (takes string, returns 9-tuple date in GMT)'''
     _date_handlers.insert(0, func)
+    _date_cache.clear()
+
+# parsed dates by date string; feeds repeat the same dates on every poll
+_date_cache = _LRUCache(1000)
     
 # ISO-8601 date parsing routines written by Fazal Majid.
 # The ISO 8601 standard is very convoluted and irregular - a full ISO 8601
@@ -2104,6 +2230,15 @@ registerDateHandler(_parse_date_hungarian)
 # Drake and licensed under the Python license.  Removed all range checking
 # for month, day, hour, minute, and second, since mktime will normalize
 # these later
+_w3dtf_date_re = ('(?P<year>\d\d\d\d)'
+                  '(?:(?P<dsep>-|)'
+                  '(?:(?P<julian>\d\d\d)'
+                  '|(?P<month>\d\d)(?:(?P=dsep)(?P<day>\d\d))?))?')
+_w3dtf_tzd_re = '(?P<tzd>[-+](?P<tzdhours>\d\d)(?::?(?P<tzdminutes>\d\d))|Z)'
+_w3dtf_time_re = ('(?P<hours>\d\d)(?P<tsep>:|)(?P<minutes>\d\d)'
+                  '(?:(?P=tsep)(?P<seconds>\d\d(?:[.,]\d+)?))?'
+                  + _w3dtf_tzd_re)
+_w3dtf_datetime_rx = re.compile('%s(?:T%s)?' % (_w3dtf_date_re, _w3dtf_time_re))
 def _parse_date_w3dtf(dateString):
     def __extract_date(m):
         year = int(m.group('year'))
@@ -2181,18 +2316,7 @@ def _parse_date_w3dtf(dateString):
             return -offset
         return offset
 
-    __date_re = ('(?P<year>\d\d\d\d)'
-                 '(?:(?P<dsep>-|)'
-                 '(?:(?P<julian>\d\d\d)'
-                 '|(?P<month>\d\d)(?:(?P=dsep)(?P<day>\d\d))?))?')
-    __tzd_re = '(?P<tzd>[-+](?P<tzdhours>\d\d)(?::?(?P<tzdminutes>\d\d))|Z)'
-    __tzd_rx = re.compile(__tzd_re)
-    __time_re = ('(?P<hours>\d\d)(?P<tsep>:|)(?P<minutes>\d\d)'
-                 '(?:(?P=tsep)(?P<seconds>\d\d(?:[.,]\d+)?))?'
-                 + __tzd_re)
-    __datetime_re = '%s(?:T%s)?' % (__date_re, __time_re)
-    __datetime_rx = re.compile(__datetime_re)
-    m = __datetime_rx.match(dateString)
+    m = _w3dtf_datetime_rx.match(dateString)
     if (m is None) or (m.group() != dateString): return
     gmt = __extract_date(m) + __extract_time(m) + (0, 0, 0)
     if gmt[0] == 0: return
@@ -2223,21 +2347,55 @@ _additional_timezones = {'AT': -400, 'ET': -500, 'CT': -600, 'MT': -700, 'PT': -
 rfc822._timezones.update(_additional_timezones)
 registerDateHandler(_parse_date_rfc822)    
 
+def _try_date_handler(handler, dateString):
+    try:
+        date9tuple = handler(dateString)
+        if not date9tuple: return None
+        if len(date9tuple) != 9:
+            if _debug: sys.stderr.write('date handler function must return 9-tuple\n')
+            raise ValueError
+        map(int, date9tuple)
+        return date9tuple
+    except Exception, e:
+        if _debug: sys.stderr.write('%s raised %s\n' % (handler.__name__, repr(e)))
+        return None
+
+def _parse_date_handler(dateString, preferred=None):
+    '''Parse a date, returning (9-tuple in GMT, handler to prefer next time)
+
+    preferred is tried before the registered handlers, otherwise W3DTF goes
+    first for anything that starts with a four digit year.  Only the strict
+    RFC 822 and W3DTF handlers are worth preferring, the others are lenient
+    enough to misread dates that a handler ahead of them would get right.'''
+    if not dateString:
+        return None, preferred
+    cached = _date_cache.get(dateString)
+    if cached is None:
+        first = preferred
+        if first is None and dateString[:4].isdigit():
+            first = _parse_date_w3dtf
+        cached = (None, None)
+        date9tuple = None
+        if first is not None:
+            date9tuple = _try_date_handler(first, dateString)
+        if date9tuple:
+            cached = (date9tuple, first)
+        else:
+            for handler in _date_handlers:
+                if handler is first: continue
+                date9tuple = _try_date_handler(handler, dateString)
+                if date9tuple:
+                    if handler not in _strict_date_handlers:
+                        handler = None
+                    cached = (date9tuple, handler)
+                    break
+        _date_cache[dateString] = cached
+    return cached[0], cached[1] or preferred
+
 def _parse_date(dateString):
     '''Parses a variety of date formats into a 9-tuple in GMT'''
-    for handler in _date_handlers:
-        try:
-            date9tuple = handler(dateString)
-            if not date9tuple: continue
-            if len(date9tuple) != 9:
-                if _debug: sys.stderr.write('date handler function must return 9-tuple\n')
-                raise ValueError
-            map(int, date9tuple)
-            return date9tuple
-        except Exception, e:
-            if _debug: sys.stderr.write('%s raised %s\n' % (handler.__name__, repr(e)))
-            pass
-    return None
+    return _parse_date_handler(dateString)[0]
+_strict_date_handlers = (_parse_date_rfc822, _parse_date_w3dtf)
 
 def _getCharacterEncoding(http_headers, xml_data):
     '''Get the character encoding of the XML document
@@ -2446,8 +2604,63 @@ def _stripDoctype(data):
     data = doctype_pattern.sub('', data)
     return version, data
     
-def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[]):
-    '''Parse a feed from a URL, file, stream, or string'''
+def _projectFields(fields):
+    '''Normalize the entry keys a caller asked for into a lookup dict
+
+    Aliases keep every key they read from, so asking for 'description'
+    keeps 'subtitle' and 'summary'.  Detail dicts such as summary_detail
+    are only kept when asked for by name.'''
+    if fields is None:
+        return None
+    wanted = {}
+    for key in fields:
+        for k in FeedParserDict._getkeys.get(key, (key,)):
+            wanted[k] = 1
+    return wanted
+
+_READ_CHUNK_SIZE = 16384
+
+def _readBody(f, encoding, max_bytes):
+    '''Read the body of f, inflating it as it arrives if encoding says so
+
+    Neither the compressed nor the inflated body is ever held beyond
+    max_bytes: BodyTooLarge is raised as soon as either passes it.'''
+    decompressor = None
+    if zlib and encoding == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif zlib and encoding == 'deflate':
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    chunks = []
+    size = 0
+    read = 0
+    while 1:
+        chunk = f.read(_READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        read += len(chunk)
+        if decompressor:
+            # inflate no more than one byte past the limit, whatever the ratio
+            chunk = decompressor.decompress(chunk, max_bytes and max_bytes - size + 1 or 0)
+        size += len(chunk)
+        if max_bytes and (size > max_bytes or read > max_bytes):
+            raise BodyTooLarge('feed body is larger than %d bytes' % max_bytes)
+        chunks.append(chunk)
+    if decompressor:
+        chunk = decompressor.flush()
+        size += len(chunk)
+        if max_bytes and size > max_bytes:
+            raise BodyTooLarge('feed body is larger than %d bytes' % max_bytes)
+        chunks.append(chunk)
+    return ''.join(chunks)
+
+def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[], fields=None, max_bytes=None):
+    '''Parse a feed from a URL, file, stream, or string
+
+    fields optionally lists the entry keys the caller will read.  Entry
+    elements outside it are skipped: not sanitized, not URI-resolved and
+    not stored.  Feed-level data is always parsed in full.
+
+    At most max_bytes of body are read, MAX_BODY_SIZE by default.'''
     result = FeedParserDict()
     result['feed'] = FeedParserDict()
     result['entries'] = []
@@ -2455,35 +2668,31 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
         result['bozo'] = 0
     if type(handlers) == types.InstanceType:
         handlers = [handlers]
+    if max_bytes is None:
+        max_bytes = MAX_BODY_SIZE
     try:
         f = _open_resource(url_file_stream_or_string, etag, modified, agent, referrer, handlers)
-        data = f.read()
     except Exception, e:
         result['bozo'] = 1
         result['bozo_exception'] = e
-        data = ''
         f = None
 
-    # if feed is gzip-compressed, decompress it
-    if f and data and hasattr(f, 'headers'):
-        if gzip and f.headers.get('content-encoding', '') == 'gzip':
-            try:
-                data = gzip.GzipFile(fileobj=_StringIO(data)).read()
-            except Exception, e:
-                # Some feeds claim to be gzipped but they're not, so
-                # we get garbage.  Ideally, we should re-request the
-                # feed without the 'Accept-encoding: gzip' header,
-                # but we don't.
-                result['bozo'] = 1
-                result['bozo_exception'] = e
-                data = ''
-        elif zlib and f.headers.get('content-encoding', '') == 'deflate':
-            try:
-                data = zlib.decompress(data, -zlib.MAX_WBITS)
-            except Exception, e:
-                result['bozo'] = 1
-                result['bozo_exception'] = e
-                data = ''
+    # read the body, decompressing it on the way in if it is gzip or deflate
+    data = ''
+    if f:
+        encoding = ''
+        if hasattr(f, 'headers'):
+            encoding = f.headers.get('content-encoding', '')
+        try:
+            data = _readBody(f, encoding, max_bytes)
+        except Exception, e:
+            # Some feeds claim to be gzipped but they're not, so
+            # we get garbage.  Ideally, we should re-request the
+            # feed without the 'Accept-encoding: gzip' header,
+            # but we don't.  Oversized feeds end up here too.
+            result['bozo'] = 1
+            result['bozo_exception'] = e
+            data = ''
 
     # save HTTP headers
     if hasattr(f, 'info'):
@@ -2597,6 +2806,7 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
     if use_strict_parser:
         # initialize the SAX parser
         feedparser = _StrictFeedParser(baseuri, baselang, 'utf-8')
+        feedparser.fields = _projectFields(fields)
         saxparser = xml.sax.make_parser(PREFERRED_XML_PARSERS)
         saxparser.setFeature(xml.sax.handler.feature_namespaces, 1)
         saxparser.setContentHandler(feedparser)
@@ -2620,6 +2830,7 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
             use_strict_parser = 0
     if not use_strict_parser:
         feedparser = _LooseFeedParser(baseuri, baselang, known_encoding and 'utf-8' or '')
+        feedparser.fields = _projectFields(fields)
         feedparser.feed(data)
     result['feed'] = feedparser.feeddata
     result['entries'] = feedparser.entries
@@ -2627,6 +2838,49 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
     result['namespaces'] = feedparser.namespacesInUse
     return result
 
+def iterparse(stream, chunk_size=16384, baseuri=None, baselang=None, fields=None):
+    '''Parse a feed from a stream incrementally, yielding (feed, entry) pairs
+
+    Entries are yielded as soon as their end tag has been read and are then
+    forgotten, so memory use is bounded by the largest single entry rather
+    than the whole document.  feed holds the feed-level elements seen so far.
+    This needs a real XML parser and well-formed input: there is no
+    encoding sniffing or loose parser fallback, parsing errors are raised
+    as xml.sax.SAXException.  fields projects entries as in parse().
+    '''
+    if not _XML_AVAILABLE:
+        raise NotImplementedError, 'incremental parsing requires an XML parser'
+    feedparser = _StrictFeedParser(baseuri, baselang, 'utf-8')
+    feedparser.fields = _projectFields(fields)
+    saxparser = xml.sax.make_parser(PREFERRED_XML_PARSERS)
+    saxparser.setFeature(xml.sax.handler.feature_namespaces, 1)
+    saxparser.setContentHandler(feedparser)
+    saxparser.setErrorHandler(feedparser)
+    if hasattr(saxparser, '_ns_stack'):
+        # work around bug in built-in SAX parser (doesn't recognize xml: namespace)
+        saxparser._ns_stack.append({'http://www.w3.org/XML/1998/namespace':'xml'})
+
+    def completed():
+        # the last entry is still being built while we are inside it
+        if feedparser.inentry:
+            done = feedparser.entries[:-1]
+            del feedparser.entries[:-1]
+        else:
+            done = feedparser.entries[:]
+            del feedparser.entries[:]
+        return done
+
+    while 1:
+        data = stream.read(chunk_size)
+        if not data:
+            break
+        saxparser.feed(data)
+        for entry in completed():
+            yield feedparser.feeddata, entry
+    saxparser.close()
+    for entry in completed():
+        yield feedparser.feeddata, entry
+
 if __name__ == '__main__':
     if not sys.argv[1:]:
         print __doc__
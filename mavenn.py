@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+"""Delivery of new stream activity to Mavenn
+
+Items are stored once per feed source and every stream following the
+source keeps its own watermark, delivered_seq: the sequence number of the
+last item posted for it.  Items are numbered in the transaction that
+stores them, so an item can't show up behind a watermark that has already
+moved past it.  Writers call queue_delivery() after storing new items,
+which schedules at most one fan-out task per source per time window.
+That task queues a delivery task for each stream following the source.
+A delivery task POSTs the stream's items past its watermark in batches,
+moves the watermark on and fails on any error so the task queue retries
+it with backoff.  Delivery never runs inside a poll or hub callback
+request.
+"""
+
+# Python imports
+import base64
+import logging
+import time
+
+# AppEngine imports
+import wsgiref.handlers
+from google.appengine.api import taskqueue
+from google.appengine.api import urlfetch
+from google.appengine.ext import db
+from google.appengine.ext import webapp
+from django.utils import simplejson
+
+# our own imports
+from models import FeedStream, FeedItem, MavennDeliveryConfig
+from config import *
+
+# new items for a source are coalesced into one task per window
+COALESCE_SECONDS = 30
+BATCH_SIZE = 50
+# batches posted per task before handing the rest to a fresh task
+MAX_BATCHES = 10
+# streams handed a delivery task per fan-out task
+FANOUT_BATCH_SIZE = 100
+
+
+def queue_delivery(source):
+  """Make sure the streams following the source get a delivery task"""
+  config = MavennDeliveryConfig.get_instance()
+  if config.is_enabled is None or config.is_enabled == False:
+    return
+  window = int(time.time() / COALESCE_SECONDS)
+  try:
+    taskqueue.Task(url='/mavenn/tasks/fanout', params={"key": str(source.key())},
+                   name="fanout-%s-%d" % (source.key().name(), window),
+                   countdown=COALESCE_SECONDS).add(queue_name="mavenn-delivery")
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    # the task for this window already covers the new items
+    pass
+
+
+def queue_stream_delivery(stream_key):
+  """Make sure a delivery task is pending for the stream"""
+  window = int(time.time() / COALESCE_SECONDS)
+  try:
+    taskqueue.Task(url='/mavenn/tasks/deliver', params={"key": str(stream_key)},
+                   name="deliver-%s-%d" % (stream_key.name(), window)).add(queue_name="mavenn-delivery")
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def mark_delivered(stream_key, since, seq):
+  """Move the stream's watermark from since on to seq.
+
+  Returns False when another worker has moved it meanwhile, the watermark
+  then stays where that worker put it and never goes backwards.
+  """
+  def txn():
+    stream = db.get(stream_key)
+    if stream is None:
+      return False
+    moved = stream.delivered_seq != since
+    stream.delivered_seq = max(stream.delivered_seq or 0, seq)
+    stream.put()
+    return not moved
+  return db.run_in_transaction(txn)
+
+
+def post_activity(stream_id, items):
+  """POST a batch of items to the stream's Mavenn activity endpoint"""
+  mavenn_activity_update = {"status": "active", "stream_id": stream_id}
+  mavenn_activity_update["activity"] = [item.to_activity() for item in items]
+  activity = simplejson.dumps(mavenn_activity_update)
+
+  url = MAVENN_API_URL % stream_id
+  pair = "%s:%s" % (FEEDBOT_MAVENN_API_KEY, FEEDBOT_MAVENN_AUTH_TOKEN)
+  token = base64.b64encode(pair)
+  headers = {"Content-Type": "application/json", "Authorization": "Basic %s" % token}
+  result = urlfetch.fetch(url, payload=activity, method=urlfetch.POST, headers=headers)
+  logging.debug(result.status_code)
+  logging.debug(result.content)
+  return result.status_code >= 200 and result.status_code < 300
+
+
+class DeliveryFanout(webapp.RequestHandler):
+  """Queue a delivery task for every live stream following a source"""
+  def post(self):
+    query = FeedStream.all(keys_only=True).filter('source =', db.Key(self.request.get("key"))).filter('deleted =', False)
+    cursor = self.request.get("cursor")
+    if cursor:
+      query.with_cursor(cursor)
+    keys = query.fetch(FANOUT_BATCH_SIZE)
+    for key in keys:
+      queue_stream_delivery(key)
+
+    # a full batch means more followers, carry on in a fresh task
+    if len(keys) == FANOUT_BATCH_SIZE:
+      taskqueue.Task(url='/mavenn/tasks/fanout', params={"key": self.request.get("key"), "cursor": query.cursor()}).add(queue_name="mavenn-delivery")
+    self.response.out.write("queued delivery for %d streams" % len(keys))
+
+
+class DeliveryWorker(webapp.RequestHandler):
+  """Post the pending activity of one stream to Mavenn"""
+  def post(self):
+    stream = FeedStream.get(db.Key(self.request.get("key")))
+    if stream is None or stream.deleted or stream.source_key() is None:
+      self.response.out.write("no stream to deliver")
+      return
+
+    enabled_since = MavennDeliveryConfig.get_instance().enabled_since
+    since = stream.delivered_seq
+    for i in range(MAX_BATCHES):
+      # ancestor queries see every item stored so far
+      query = FeedItem.all().ancestor(stream.source_key())
+      if since is None:
+        # a new stream starts out with the latest items of its source
+        items = query.order('-seq').fetch(BATCH_SIZE)
+        items.reverse()
+      else:
+        items = query.filter('seq >', since).order('seq').fetch(BATCH_SIZE)
+      if len(items) == 0:
+        self.response.out.write("activity delivered")
+        return
+
+      # items from before delivery was enabled are history, not activity
+      to_post = [item for item in items if enabled_since is None or item.created >= enabled_since]
+      if len(to_post) > 0:
+        try:
+          delivered = post_activity(stream.stream_id, to_post)
+        except urlfetch.Error, e:
+          logging.warn("mavenn delivery failed for %s: %r" % (stream.stream_id, e))
+          delivered = False
+        if not delivered:
+          # let the task queue retry with backoff
+          self.error(500)
+          return
+
+      if not mark_delivered(stream.key(), since, items[-1].seq):
+        # another worker is delivering this stream too, leave the rest to it
+        self.response.out.write("activity delivery taken over")
+        return
+      since = items[-1].seq
+
+    # still more pending, continue in a fresh task, named after the watermark so it runs once
+    try:
+      taskqueue.Task(url='/mavenn/tasks/deliver', params={"key": str(stream.key())},
+                     name="deliver-%s-from-%d" % (stream.key().name(), since)).add(queue_name="mavenn-delivery")
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      pass
+    self.response.out.write("activity delivery continued")
+
+
+def main():
+  logging.getLogger().setLevel(logging.DEBUG)
+  application = webapp.WSGIApplication([
+          (r'/mavenn/tasks/fanout', DeliveryFanout),
+          (r'/mavenn/tasks/deliver', DeliveryWorker),
+          ], debug=True)
+  wsgiref.handlers.CGIHandler().run(application)
+
+if __name__ == "__main__":
+  main()
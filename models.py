@@ -10,8 +10,10 @@ import hashlib
 import logging
 import random
 import time
+import urlparse
 
 # AppEngine imports
+from google.appengine.api import memcache
 from google.appengine.ext import db
 from django.utils import simplejson
 
@@ -39,35 +41,493 @@ class Configuration(db.Model):
 
 class FeedPollerConfig(Configuration):
   is_enabled = db.BooleanProperty(default=False)
+  # fan-out mode: each wake up starts a one-off worker per shard instead of a chain
+  is_fanout = db.BooleanProperty(default=False)
+  batch_size = db.IntegerProperty(default=20) # feeds a worker leases at a time
+  shards = db.IntegerProperty(default=8) # poll workers running side by side, one per shard
+  # politeness towards hosts serving many feeds, shared by every worker
+  host_rate = db.IntegerProperty(default=2) # requests per second
+  host_concurrency = db.IntegerProperty(default=4) # requests in flight
+  # streams stored before feed sources get attached to one once, by the cron
+  sources_backfilled = db.BooleanProperty(default=False)
 
 
-class FeedStream(db.Model):
-  stream_id = db.StringProperty(required=True)
-  title = db.StringProperty(required=True)
+class FeedBotConfig(Configuration):
+  # answer stream creation right away and find the feed url in a task
+  async_create = db.BooleanProperty(default=False)
+
+
+class MavennDeliveryConfig(Configuration):
+  is_enabled = db.BooleanProperty(default=False)
+  # items stored before delivery was switched on are never posted
+  enabled_since = db.DateTimeProperty()
+
+
+def _cache_generation(cache_key):
+  """Current value of a generation counter, part of every cached response key"""
+  generation = memcache.get(cache_key)
+  if generation is None:
+    # seed from the clock so a lost counter doesn't revive old responses
+    generation = int(time.time())
+    memcache.add(cache_key, generation)
+  return generation
+
+
+def _invalidate_generation(cache_key):
+  """Move a generation counter on, orphaning everything cached under the old one"""
+  if memcache.incr(cache_key, initial_value=int(time.time())) is None:
+    logging.error("memcache incr failed")
+
+
+class FeedSource(db.Model):
+  """A feed as fetched from the web, shared by every FeedStream following it.
+  Key name is a hash of the normalized feed url.
+  """
   url = db.LinkProperty()
   format = db.StringProperty()
   http_status = db.StringProperty()
   http_last_modified = db.DateTimeProperty()
   http_etag = db.StringProperty()
+  content_digest = db.StringProperty() # sha1 of the last body we parsed
+  skipped_parses = db.IntegerProperty(default=0)
+  delta_polls = db.IntegerProperty(default=0) # 226 responses with only what changed
   last_polled = db.DateTimeProperty(default=datetime.datetime(1900,1,1))
+  has_error = db.BooleanProperty(default=False)
+  hold_until = db.DateTimeProperty() # the server asked not to be polled before then
+  active = db.BooleanProperty(default=True) # false once no live stream follows it
+  followers = db.IntegerProperty(default=0) # live streams following the source
+  shard = db.IntegerProperty() # poll workers each own one shard
+  lease_owner = db.StringProperty() # worker polling the source right now
+  lease_expires = db.DateTimeProperty()
+  # adaptive polling schedule
+  next_poll_at = db.DateTimeProperty(default=datetime.datetime(1900,1,1))
+  poll_interval = db.IntegerProperty() # estimated seconds between updates
+  last_new_item_at = db.DateTimeProperty()
+  unchanged_polls = db.IntegerProperty(default=0) # 304s and polls without new items in a row
+  error_count = db.IntegerProperty(default=0)
+  created = db.DateTimeProperty(auto_now_add=True)
+  updated = db.DateTimeProperty(auto_now=True)
+
+  MIN_POLL_INTERVAL = 10 * 60
+  MAX_POLL_INTERVAL = 24 * 60 * 60
+  DEFAULT_POLL_INTERVAL = 60 * 60
+
+  # a worker that hasn't finished with a source by then is presumed dead
+  LEASE_TIME = 5 * 60
+  # what a poll finds out, save_poll() writes just these
+  POLL_FIELDS = ('http_status', 'http_last_modified', 'http_etag', 'content_digest', 'skipped_parses',
+                 'delta_polls', 'last_polled', 'has_error', 'hold_until', 'next_poll_at', 'poll_interval',
+                 'last_new_item_at', 'unchanged_polls', 'error_count')
+
+  @classmethod
+  def normalize_url(cls, url):
+    """Canonical spelling of a feed url, so streams of the same feed share a source"""
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url.strip())
+    scheme = scheme.lower()
+    netloc = netloc.lower()
+    if (scheme == 'http' and netloc.endswith(':80')) or (scheme == 'https' and netloc.endswith(':443')):
+      netloc = netloc.rsplit(':', 1)[0]
+    return urlparse.urlunsplit((scheme, netloc, path or '/', query, ''))
+
+  @classmethod
+  def key_name_for_url(cls, url):
+    return 'z' + hashlib.sha1(cls.normalize_url(url)).hexdigest()
+
+  @classmethod
+  def follow(cls, url, stream_key):
+    """Count the stream as a follower of the feed at url, returns (source, needs_poll).
+
+    The source is created if need be.  needs_poll is true when the source
+    was just created or had gone idle, a source that is already being
+    polled has items to show right away.  Each stream is counted once, so
+    a retried task can call this again.
+    """
+    key_name = cls.key_name_for_url(url)
+    def txn():
+      source = cls.get_by_key_name(key_name)
+      woke = source is None or not source.active
+      if source is None:
+        source = cls(key_name=key_name, url=cls.normalize_url(url))
+      follower = SourceFollower.get_by_key_name(stream_key.name(), parent=source)
+      if follower is not None and not woke:
+        return source, False
+      source.active = True
+      source.shard = cls.shard_for(key_name)
+      if follower is None:
+        source.followers = (source.followers or 0) + 1
+        follower = SourceFollower(key_name=stream_key.name(), parent=source)
+      db.put([source, follower])
+      return source, woke
+    return db.run_in_transaction(txn)
+
+  @classmethod
+  def unfollow(cls, key, stream_key):
+    """Stop counting the stream as a follower, returns True when the source went idle"""
+    def txn():
+      source = db.get(key)
+      if source is None:
+        return False
+      follower = SourceFollower.get_by_key_name(stream_key.name(), parent=source)
+      if follower is None:
+        return False
+      follower.delete()
+      source.followers = max((source.followers or 0) - 1, 0)
+      if source.followers == 0:
+        source.active = False
+      source.put()
+      return not source.active
+    return db.run_in_transaction(txn)
+
+  @classmethod
+  def shard_count(cls):
+    return max(FeedPollerConfig.get_instance().shards or 1, 1)
+
+  @classmethod
+  def shard_for(cls, key_name):
+    return int(key_name[1:9], 16) % cls.shard_count()
+
+  @classmethod
+  def claim_due(cls, shard, owner, limit):
+    """Lease up to limit due sources of a shard to owner.
+
+    Claiming moves next_poll_at to the end of the lease in the same
+    transaction, so a claimed source drops out of every other worker's due
+    query and comes due again by itself if its owner dies.
+    """
+    now = datetime.datetime.utcnow()
+    keys = cls.all(keys_only=True).filter('active =', True).filter('shard =', shard).filter('next_poll_at <=', now).order('next_poll_at').fetch(limit)
+    claimed = []
+    for key in keys:
+      source = db.run_in_transaction(cls._claim, key, owner, now)
+      if source is not None:
+        claimed.append(source)
+    return claimed
+
+  @classmethod
+  def claim(cls, key, owner):
+    """Lease one source to owner whether it is due or not, None while another worker holds it"""
+    return db.run_in_transaction(cls._claim, key, owner, datetime.datetime.utcnow(), False)
+
+  @classmethod
+  def _claim(cls, key, owner, now, due_only=True):
+    source = cls.get(key)
+    if source is None or not source.active:
+      return None
+    if due_only and source.next_poll_at > now:
+      # another worker got there first
+      return None
+    if not due_only and source.lease_owner is not None and source.lease_expires > now:
+      return None
+    source.due_at = source.next_poll_at # kept for the poller's lag figures, not stored
+    source.lease_owner = owner
+    source.lease_expires = now + datetime.timedelta(seconds=cls.LEASE_TIME)
+    source.next_poll_at = source.lease_expires
+    source.put()
+    return source
+
+  def postpone(self, seconds):
+    """Try again shortly, without counting it as a poll"""
+    self.next_poll_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)
+
+  def hold_off(self, seconds):
+    """Don't poll again before the server says, within our own longest interval"""
+    if seconds is None:
+      return
+    self.hold_until = datetime.datetime.utcnow() + datetime.timedelta(seconds=min(seconds, self.MAX_POLL_INTERVAL))
+    if self.hold_until > self.next_poll_at:
+      self.next_poll_at = self.hold_until
+
+  def save_poll(self):
+    """Store what the poll found and give up the lease.
+
+    The source is read again in a transaction and only the poll fields are
+    copied over, so concurrent edits of anything else survive.  Nothing is
+    written if the lease ran out and another worker has claimed the
+    source since, returns False then.
+    """
+    def txn():
+      source = db.get(self.key())
+      if source is None or source.lease_owner != self.lease_owner:
+        return False
+      for name in self.POLL_FIELDS:
+        setattr(source, name, getattr(self, name))
+      source.lease_owner = None
+      source.lease_expires = None
+      source.put()
+      return True
+    saved = db.run_in_transaction(txn)
+    if saved:
+      self.lease_owner = None
+      self.lease_expires = None
+    return saved
+
+  @classmethod
+  def record_push(cls, key, new_items):
+    """Count a hub notification as a poll, leaving the lease and validators alone"""
+    def txn():
+      source = db.get(key)
+      if source is None:
+        return None
+      source.last_polled = datetime.datetime.utcnow()
+      source.schedule_next_poll(new_items)
+      source.put()
+      return source
+    return db.run_in_transaction(txn)
+
+  @classmethod
+  def reset_validators(cls, key):
+    """Forget what we know of the feed so the next poll, due right away, fetches and parses it in full"""
+    def txn():
+      source = db.get(key)
+      if source is None:
+        return None
+      source.http_status = None
+      source.http_etag = None
+      source.http_last_modified = None
+      source.content_digest = None
+      source.last_polled = datetime.datetime(1900,1,1)
+      source.next_poll_at = datetime.datetime(1900,1,1)
+      source.put()
+      return source
+    return db.run_in_transaction(txn)
+
+  @classmethod
+  def generation_cache_key(cls, key):
+    return "feedsource_generation_%s" % key.name()
+
+  def invalidate_cache(self):
+    """Drop the cached renderings of every stream following the source"""
+    _invalidate_generation(self.generation_cache_key(self.key()))
+
+  def schedule_next_poll(self, new_items=0, error=False):
+    """Work out when the feed should be polled next.
+
+    Busy feeds converge on the observed gap between new items, every poll
+    that turns up nothing backs off a little further and failing feeds back
+    off exponentially.
+    """
+    now = datetime.datetime.utcnow()
+    interval = self.poll_interval or self.DEFAULT_POLL_INTERVAL
+    if error:
+      self.error_count = (self.error_count or 0) + 1
+      delay = max(interval, self.MIN_POLL_INTERVAL * 2 ** min(self.error_count, 10))
+      self.next_poll_at = now + datetime.timedelta(seconds=min(delay, self.MAX_POLL_INTERVAL))
+      return
+
+    self.error_count = 0
+    if new_items > 0:
+      if self.last_new_item_at is not None:
+        elapsed = now - self.last_new_item_at
+        observed = (elapsed.days * 24 * 60 * 60 + elapsed.seconds) / new_items
+        interval = (interval + observed) / 2
+      else:
+        interval = interval / 2
+      self.last_new_item_at = now
+      self.unchanged_polls = 0
+    else:
+      self.unchanged_polls = (self.unchanged_polls or 0) + 1
+      interval = interval * 3 / 2
+    self.poll_interval = max(self.MIN_POLL_INTERVAL, min(interval, self.MAX_POLL_INTERVAL))
+    self.next_poll_at = now + datetime.timedelta(seconds=self.poll_interval)
+
+
+class SourceFollower(db.Model):
+  """Marks a stream as counted among its source's followers, a child of the source.
+  Key name is the stream's key name.
+  """
+  created = db.DateTimeProperty(auto_now_add=True)
+
+
+class FeedStream(db.Model):
+  """A Mavenn stream following a feed, the feed itself is fetched through its source"""
+  stream_id = db.StringProperty(required=True)
+  title = db.StringProperty(required=True)
+  url = db.LinkProperty()
+  source = db.ReferenceProperty(FeedSource, collection_name='streams')
   deleted = db.BooleanProperty()
   pshb_verify_token = db.StringProperty()  # Random verification token
   pshb_hub_url = db.LinkProperty() # store and track it, in case the publisher moves its hub
   pshb_is_subscribed = db.BooleanProperty()
-  has_error = db.BooleanProperty(default=False)
+  status = db.StringProperty(default='active') # resolving until the feed url is known
+  delivered_seq = db.IntegerProperty() # sequence number of the last source item posted to Mavenn
   created = db.DateTimeProperty(auto_now_add=True)
   updated = db.DateTimeProperty(auto_now=True)
+
+  STATUS_RESOLVING = 'resolving'
+  STATUS_ACTIVE = 'active'
+  STATUS_FAILED = 'failed'
   
   @classmethod
   def get_by_url(cls, url):
     return cls.all().filter('url =', url).get()
 
+  def current_status(self):
+    # streams stored before there was a status are all active
+    return self.status or self.STATUS_ACTIVE
+
+  def source_key(self):
+    """Key of the stream's source without fetching it, None until it has one"""
+    return FeedStream.source.get_value_for_datastore(self)
+
+  def item_query(self):
+    """Query for the stream's items, which live with its source"""
+    source_key = self.source_key()
+    if source_key is None:
+      # streams stored before sources kept items of their own
+      return self.items
+    return FeedItem.all().filter('source =', source_key)
+
+  def mark_deleted(self):
+    """Flag the stream deleted, returns False when it already was"""
+    def txn():
+      stream = db.get(self.key())
+      if stream is None or stream.deleted:
+        return False
+      stream.deleted = True
+      stream.put()
+      return True
+    deleted = db.run_in_transaction(txn)
+    self.deleted = True
+    return deleted
+
+  def _generation_cache_key(self):
+    return "feedstream_generation_%s" % self.stream_id
+
+  def cache_generation(self):
+    """Version of the stream and its source's items, part of every cached response key"""
+    generation = str(_cache_generation(self._generation_cache_key()))
+    source_key = self.source_key()
+    if source_key is not None:
+      generation += '.%s' % _cache_generation(FeedSource.generation_cache_key(source_key))
+    return generation
+
+  def invalidate_cache(self):
+    """Drop every cached rendering of the stream by moving to a new generation"""
+    _invalidate_generation(self._generation_cache_key())
+
+
+class PollerHeartbeat(db.Model):
+  """Last sign of life of the poll workers of one shard.
+  Key name is shard_ and the shard number.
+  """
+  shard = db.IntegerProperty()
+  epoch = db.IntegerProperty() # moved on whenever the watchdog starts a new chain
+  state = db.StringProperty(default='asleep')
+  last_beat = db.DateTimeProperty()
+  lag_seconds = db.IntegerProperty(default=0) # how overdue the oldest feed of the last batch was
+  last_batch = db.IntegerProperty(default=0)
+  polled = db.IntegerProperty(default=0) # feeds polled since the chain started
+  restarts = db.IntegerProperty(default=0) # chains found dead and replaced
+  # one-off fan-out workers keep to these, the rest belongs to the shard's chain
+  last_fanout = db.DateTimeProperty()
+  fanout_polled = db.IntegerProperty(default=0)
+
+  STATE_RUNNING = 'running'
+  STATE_ASLEEP = 'asleep'
+  # a running chain that hasn't beaten for this long is presumed dead
+  STALE_TIME = 5 * 60
+
+  @classmethod
+  def key_for(cls, shard):
+    return db.Key.from_path(cls.kind(), 'shard_%d' % shard)
+
+  @classmethod
+  def for_shards(cls, shards):
+    return db.get([cls.key_for(shard) for shard in shards])
+
+  def is_alive(self, now):
+    """True while a chain holds the shard and keeps beating"""
+    if self.state != self.STATE_RUNNING or self.last_beat is None:
+      return False
+    return now - self.last_beat < datetime.timedelta(seconds=self.STALE_TIME)
+
+  def age(self):
+    if self.last_beat is None:
+      return None
+    elapsed = datetime.datetime.utcnow() - self.last_beat
+    return elapsed.days * 24 * 60 * 60 + elapsed.seconds
+
+  @classmethod
+  def beat(cls, shard, epoch, state, batch=0, lag=0):
+    """Record that a worker of the shard is alive.
+
+    Workers of a chain pass its epoch and get False back once the watchdog
+    has handed the shard to a newer chain.  One-off workers pass None and
+    only count their polls, the state and last beat stay the chain's.
+    """
+    def txn():
+      heartbeat = db.get(cls.key_for(shard))
+      if heartbeat is None:
+        heartbeat = cls(key=cls.key_for(shard), shard=shard)
+      if epoch is None:
+        heartbeat.last_fanout = datetime.datetime.utcnow()
+        heartbeat.fanout_polled = (heartbeat.fanout_polled or 0) + batch
+        heartbeat.put()
+        return True
+      if heartbeat.epoch != epoch:
+        return False
+      heartbeat.state = state
+      heartbeat.last_beat = datetime.datetime.utcnow()
+      heartbeat.last_batch = batch
+      heartbeat.lag_seconds = lag
+      heartbeat.polled = (heartbeat.polled or 0) + batch
+      heartbeat.put()
+      return True
+    return db.run_in_transaction(txn)
+
+  @classmethod
+  def take_over(cls, shard):
+    """Hand the shard to a new chain, returns its epoch or None if a live chain holds it"""
+    def txn():
+      now = datetime.datetime.utcnow()
+      heartbeat = db.get(cls.key_for(shard))
+      if heartbeat is None:
+        # seed from the clock so epochs, and the task names built from them, never repeat
+        heartbeat = cls(key=cls.key_for(shard), shard=shard, epoch=int(time.time()))
+      elif heartbeat.is_alive(now):
+        return None
+      else:
+        heartbeat.epoch = (heartbeat.epoch or int(time.time())) + 1
+        if heartbeat.state == cls.STATE_RUNNING:
+          heartbeat.restarts = (heartbeat.restarts or 0) + 1
+      heartbeat.state = cls.STATE_RUNNING
+      heartbeat.last_beat = now
+      heartbeat.polled = 0
+      heartbeat.put()
+      return heartbeat.epoch
+    return db.run_in_transaction(txn)
+
+
+class CacheEntry(db.Model):
+  """A pickled value cached in the datastore, behind memcache.
+  Key name is the cache key.
+  """
+  value = db.BlobProperty()
+  expires = db.DateTimeProperty()
+
+
+class ItemSequence(db.Model):
+  """Counter numbering the items stored for a source, a child of the source"""
+  last = db.IntegerProperty(default=0)
+
+  KEY_NAME = 'seq'
+
+  @classmethod
+  def current(cls, source_key):
+    """Number of the last item stored for the source, 0 before the first"""
+    sequence = cls.get_by_key_name(cls.KEY_NAME, parent=source_key)
+    if sequence is None:
+      return 0
+    return sequence.last
+
 
 class FeedItem(db.Model):
   """An invidual story or item from a feed.
-  Key name will be a hash of the feed source and item ID.
+  Key name will be a hash of the feed source and item ID, the parent is
+  the source.
   """
-  stream = db.ReferenceProperty(FeedStream, collection_name='items')
+  source = db.ReferenceProperty(FeedSource, collection_name='items')
+  stream = db.ReferenceProperty(FeedStream, collection_name='items') # items stored before sources
   id = db.StringProperty()
   title = db.StringProperty()
   author = db.StringProperty()
@@ -76,9 +536,20 @@ class FeedItem(db.Model):
   content = db.TextProperty()
   published = db.DateTimeProperty()
   updated = db.DateTimeProperty()
-  mavenn_posted_at = db.DateTimeProperty()
+  fingerprint = db.StringProperty() # hash of the fields we store, changes when the entry is edited
+  seq = db.IntegerProperty() # order the source stored the item in, delivery follows it
   created = db.DateTimeProperty(auto_now_add=True)
 
+  # the entry keys process_entry reads, everything else can be skipped when parsing
+  PARSED_FIELDS = ('link', 'feedburner_origlink', 'title', 'author', 'description', 'id', 'published', 'updated')
+
+  # items written per transaction by store()
+  STORE_BATCH_SIZE = 100
+
+  # how many recently seen items are remembered per source
+  SEEN_CACHE_SIZE = 500
+  SEEN_CACHE_TIME = 60 * 60 * 24
+
   def to_activity(self):
     activity_time = self.published
     if activity_time is None:
@@ -102,6 +573,10 @@ class FeedItem(db.Model):
       }
     return activity
 
+  @classmethod
+  def key_name_for(cls, link, entry_id, source):
+    return 'z' + hashlib.sha1(link + '\n' + entry_id + '\n' + source.key().name()).hexdigest()
+
   @classmethod
   def process_entry(cls, entry, feed):
     """Prepare the feed entry, converting it to our FeedItem model"""
@@ -138,9 +613,9 @@ class FeedItem(db.Model):
         
     feeditem = None  
     try:
-      entry_key_name = 'z' + hashlib.sha1(link + '\n' + entry_id + '\n' + feed.stream_id).hexdigest()
-      feeditem = cls(key_name=entry_key_name,
-        stream=feed,
+      feeditem = cls(key_name=cls.key_name_for(link, entry_id, feed),
+        parent=feed,
+        source=feed,
         id=entry_id,
         title=title,
         url=link,
@@ -148,8 +623,131 @@ class FeedItem(db.Model):
         author=author,
         published=published,
         updated=updated)
+      feeditem.fingerprint = feeditem.compute_fingerprint()
     except:
       logging.warn("Failed to process: %s %s" % (link, entry_id))
       logging.error(sys.exc_info()[0])
 
     return feeditem
+
+  def copy_for_source(self, source):
+    """Copy an item stored before sources to source, keyed as process_entry would"""
+    copy = FeedItem(key_name=self.key_name_for(self.url or '', self.id or '', source),
+      parent=source,
+      source=source,
+      id=self.id,
+      title=self.title,
+      url=self.url,
+      summary=self.summary,
+      content=self.content,
+      author=self.author,
+      published=self.published,
+      updated=self.updated,
+      created=self.created)
+    copy.fingerprint = self.revision()
+    return copy
+
+  @classmethod
+  def _seen_cache_key(cls, source):
+    return "feeditems_seen_%s" % source.key().name()
+
+  def compute_fingerprint(self):
+    """Hash of the entry fields we store"""
+    parts = []
+    for value in (self.title, self.url, self.author, self.summary, self.published, self.updated):
+      if value is None:
+        value = ''
+      if isinstance(value, unicode):
+        value = value.encode('utf-8')
+      parts.append(str(value))
+    return hashlib.sha1('\n'.join(parts)).hexdigest()
+
+  def revision(self):
+    """What identifies this version of the item, used to spot changed entries"""
+    # items stored before fingerprints existed get theirs computed on the fly
+    return self.fingerprint or self.compute_fingerprint()
+
+  @classmethod
+  def classify(cls, source, items):
+    """Sort parsed items into (new, changed, unchanged) lists.
+
+    Key names and revisions recently seen for the source are remembered in
+    memcache, the rest are checked with a single batch get instead of one
+    get per item.  Changed items keep the sequence number and creation
+    time of the stored copy they replace, so they are not delivered again.
+    Repeats within items are dropped.
+    """
+    seen = dict(cls._recently_seen(source))
+    new = []
+    changed = []
+    unchanged = []
+    candidates = []
+    names = set()
+    for item in items:
+      name = item.key().name()
+      if name in names:
+        continue
+      names.add(name)
+      if name in seen and seen[name] == item.revision():
+        unchanged.append(item)
+      else:
+        candidates.append(item)
+    if len(candidates) == 0:
+      return new, changed, unchanged
+
+    for item, stored in zip(candidates, db.get([item.key() for item in candidates])):
+      if stored is None:
+        new.append(item)
+      elif stored.revision() == item.revision():
+        unchanged.append(item)
+      else:
+        item.seq = stored.seq
+        item.created = stored.created
+        changed.append(item)
+    return new, changed, unchanged
+
+  @classmethod
+  def store(cls, source, new, changed=()):
+    """Write new and changed items of the source, numbering the new ones.
+
+    Each batch is written in one transaction with the source's
+    ItemSequence, so a reader never sees a number before the items below
+    it are stored.
+    """
+    items = [(item, True) for item in new] + [(item, False) for item in changed]
+    for start in range(0, len(items), cls.STORE_BATCH_SIZE):
+      batch = items[start:start + cls.STORE_BATCH_SIZE]
+      def txn():
+        sequence = ItemSequence.get_by_key_name(ItemSequence.KEY_NAME, parent=source)
+        if sequence is None:
+          sequence = ItemSequence(key_name=ItemSequence.KEY_NAME, parent=source)
+        for item, is_new in batch:
+          if is_new:
+            sequence.last += 1
+            item.seq = sequence.last
+        db.put([sequence] + [item for item, is_new in batch])
+      db.run_in_transaction(txn)
+
+  @classmethod
+  def _recently_seen(cls, source):
+    """(key name, revision) pairs remembered for the source, oldest first"""
+    seen = memcache.get(cls._seen_cache_key(source))
+    if isinstance(seen, dict):
+      # written before the cache kept its order
+      return seen.items()
+    if not isinstance(seen, list):
+      return []
+    return seen
+
+  @classmethod
+  def mark_seen(cls, source, items):
+    """Remember the key names and revisions of stored items for the next check.
+
+    Once the cache is full the entries seen longest ago are dropped.
+    """
+    latest = [(item.key().name(), item.revision()) for item in items]
+    names = set([name for name, revision in latest])
+    seen = [(name, revision) for name, revision in cls._recently_seen(source) if name not in names]
+    seen = (seen + latest)[-cls.SEEN_CACHE_SIZE:]
+    if not memcache.set(cls._seen_cache_key(source), seen, time=cls.SEEN_CACHE_TIME):
+      logging.error("memcache set failed")
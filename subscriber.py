@@ -17,7 +17,7 @@ import random
 import urllib
 import urlparse
 import wsgiref.handlers
-from datetime import datetime
+import xml.sax
 
 from google.appengine.api import urlfetch
 from google.appengine.ext import db
@@ -26,7 +26,9 @@ from google.appengine.ext.webapp import template
 from django.utils import simplejson
 
 from lib import feedparser
-from models import FeedStream, FeedItem
+from models import FeedSource, FeedStream, FeedItem
+from mavenn import queue_delivery
+from feedpoller import attach_source
 from config import *
 
 
@@ -112,69 +114,79 @@ class CallbackHandler(webapp.RequestHandler):
     self.response.headers['Content-Type'] = 'text/plain'
     self.response.out.write(challenge)
 
+  # entries are stored in batches of this size while the body is parsed
+  BATCH_SIZE = 20
+
   def post(self, stream_id):
     """Handles Content Distribution notifications."""
     logging.debug(self.request.headers)
-    logging.debug(self.request.body)
-
-    feed = feedparser.parse(self.request.body)
-    if feed.bozo:
-      logging.error('Bozo feed data. %s: %r',
-                     feed.bozo_exception.__class__.__name__,
-                     feed.bozo_exception)
-      if (hasattr(feed.bozo_exception, 'getLineNumber') and
-          hasattr(feed.bozo_exception, 'getMessage')):
-        line = feed.bozo_exception.getLineNumber()
-        logging.error('Line %d: %s', line, feed.bozo_exception.getMessage())
-        segment = self.request.body.split('\n')[line-1]
-        logging.info('Body segment with error: %r', segment.decode('utf-8'))
-      return self.response.set_status(500)
 
     feedstream = FeedStream.get_by_key_name("z%s" % stream_id)
     if feedstream is None:
       logging.warn("Discarding update from unknown feed '%s'", stream_id)
       self.error(404)
       return
+    if feedstream.source_key() is None:
+      if feedstream.deleted or not feedstream.url or feedstream.current_status() != FeedStream.STATUS_ACTIVE:
+        logging.warn("Discarding update for stream '%s' without a feed", stream_id)
+        self.error(404)
+        return
+      # stored before sources and not backfilled yet
+      feedstream = attach_source(feedstream)
+
+    # items are stored with the source, shared by every stream following it
+    source = feedstream.source
+    logging.info("Processing update for feed '%s'", source.url)
+
+    # parse entry by entry so only one entry and one batch are held at a time
+    found = 0
+    counts = {"new": 0, "changed": 0, "duplicate": 0}
+    batch = []
+    try:
+      for feed, entry in feedparser.iterparse(self.request.body_file, fields=FeedItem.PARSED_FIELDS):
+        found += 1
+        item = FeedItem.process_entry(entry, source)
+        if item is not None:
+          batch.append(item)
+        if len(batch) >= self.BATCH_SIZE:
+          self.store_items(source, batch, counts)
+          batch = []
+    except (xml.sax.SAXException, feedparser.UndeclaredNamespace), e:
+      logging.error('Bozo feed data. %s: %r', e.__class__.__name__, e)
+      if hasattr(e, 'getLineNumber') and hasattr(e, 'getMessage'):
+        line = e.getLineNumber()
+        logging.error('Line %d: %s', line, e.getMessage())
+        # the body file has been read through, the buffered body hasn't
+        for segment in self.request.body.split('\n')[line-1:line]:
+          logging.info('Body segment with error: %r', segment.decode('utf-8', 'replace'))
+      return self.response.set_status(500)
+    self.store_items(source, batch, counts)
 
-    logging.info("Processing update for feed '%s'", feedstream.url)
-    logging.info('Found %d entries', len(feed.entries))
-
-    to_put = []  # batch datastore updates
-    for entry in feed.entries:
-      item = FeedItem.process_entry(entry, feedstream)
-      if item is not None:
-        to_put.append(item)
-    if len(to_put) > 0:
-      db.put(to_put)
+    logging.info('Found %d entries: %d new, %d changed, %d duplicate', found,
+                 counts["new"], counts["changed"], counts["duplicate"])
+    if counts["new"] + counts["changed"] > 0:
       # update feed last_polled or http_last_modified so feed poller doesn't have to check this feed for a while
-      feedstream.last_polled = datetime.utcnow()
-      feedstream.put()
-      #self.update_mavenn_activity(feedstream.stream_id, to_put)
+      FeedSource.record_push(source.key(), counts["new"])
+    if counts["new"] > 0:
+      queue_delivery(source)
 
     # Response headers (body can be empty) 
     # X-Hub-On-Behalf-Of
     self.response.set_status(200)
     self.response.out.write("ok");
 
-  def update_mavenn_activity(self, stream_id, items):
-    mavenn_activity_update = {"status": "active", "stream_id": stream_id}
-    activities = []
-    for item in items:
-      activities.append(item.to_activity())
-    mavenn_activity_update["activity"] = activities
-    activity = simplejson.dumps(mavenn_activity_update)
-    
-    logging.debug("notifying mavenn")
-    url = MAVENN_API_URL % stream_id
-    pair = "%s:%s" % (FEEDBOT_MAVENN_API_KEY, FEEDBOT_MAVENN_AUTH_TOKEN)
-    token = base64.b64encode(pair)
-    headers = {"Content-Type": "application/json", "Authorization": "Basic %s" % token}
-    #logging.debug(headers)
-    #logging.debug(activity)
-    result = urlfetch.fetch(url, payload=activity, method=urlfetch.POST,headers=headers)
-    logging.debug(result.status_code)
-    logging.debug(result.headers)
-    logging.debug(result.content)
+  def store_items(self, source, items, counts):
+    """Write the new and changed items of a batch, hubs redeliver a lot"""
+    if len(items) == 0:
+      return
+    new, changed, unchanged = FeedItem.classify(source, items)
+    counts["new"] += len(new)
+    counts["changed"] += len(changed)
+    counts["duplicate"] += len(items) - len(new) - len(changed)
+    if len(new) + len(changed) > 0:
+      FeedItem.store(source, new, changed)
+      source.invalidate_cache()
+    FeedItem.mark_seen(source, items)
 
 
 def find_feed_url(linkrel, links):
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+"""Microbenchmarks for the feed parsing hot path.
+
+Not part of the test suite (testrunner.py only discovers test*.py).  Run it
+before and after touching lib/feedparser.py and compare:
+
+    python tests/bench_feedparser.py [ENTRIES] [ROUNDS]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib import feedparser
+
+RSS_ITEM = """
+  <item>
+    <title>Entry number %(i)d &amp; friends</title>
+    <link>http://example.com/blog/%(i)d</link>
+    <guid isPermaLink="false">tag:example.com,2010:%(i)d</guid>
+    <pubDate>Mon, %(day)02d Sep 2010 16:45:%(sec)02d GMT</pubDate>
+    <dc:creator>Author %(i)d</dc:creator>
+    <feedburner:origLink>http://example.com/orig/%(i)d</feedburner:origLink>
+    <description>&lt;p&gt;Summary of &lt;a href="/posts/%(i)d"&gt;entry %(i)d&lt;/a&gt;
+      with &lt;b&gt;markup&lt;/b&gt; &lt;img src="/img/%(i)d.png"&gt;&lt;script&gt;alert(1)&lt;/script&gt;&lt;/p&gt;</description>
+    <media:thumbnail url="http://example.com/thumb/%(i)d.jpg"/>
+    <itunes:duration>00:%(sec)02d:00</itunes:duration>
+  </item>"""
+
+ATOM_ENTRY = """
+  <entry>
+    <title type="html">Entry number %(i)d</title>
+    <link rel="alternate" href="/blog/%(i)d"/>
+    <id>tag:example.com,2010:%(i)d</id>
+    <published>2010-09-%(day)02dT16:45:%(sec)02dZ</published>
+    <updated>2010-09-%(day)02dT17:45:%(sec)02d+02:00</updated>
+    <author><name>Author %(i)d</name><email>a%(i)d@example.com</email></author>
+    <summary type="html">&lt;p&gt;Summary of &lt;a href="/posts/%(i)d"&gt;entry %(i)d&lt;/a&gt;&lt;/p&gt;</summary>
+    <content type="html">&lt;div&gt;&lt;p class="x" onclick="evil()"&gt;Body %(i)d&lt;/p&gt;&lt;img src="/img/%(i)d.png"&gt;&lt;/div&gt;</content>
+  </entry>"""
+
+
+def make_rss(entries):
+  items = ''.join([RSS_ITEM % {'i': i, 'day': i % 28 + 1, 'sec': i % 60} for i in range(entries)])
+  return """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0" xmlns:dc="http://purl.org/dc/elements/1.1/"
+     xmlns:feedburner="http://rssnamespace.org/feedburner/ext/1.0"
+     xmlns:media="http://search.yahoo.com/mrss"
+     xmlns:itunes="http://www.itunes.com/DTDs/PodCast-1.0.dtd">
+<channel><title>Benchmark RSS</title><link>http://example.com/</link>
+<description>bench</description>%s
+</channel></rss>""" % items
+
+
+def make_atom(entries):
+  items = ''.join([ATOM_ENTRY % {'i': i, 'day': i % 28 + 1, 'sec': i % 60} for i in range(entries)])
+  return """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xml:base="http://example.com/">
+<title>Benchmark Atom</title><id>tag:example.com,2010:feed</id>
+<updated>2010-09-06T16:45:00Z</updated>%s
+</feed>""" % items
+
+
+# date strings as they turn up in the feeds we poll, most common formats first
+DATES = [
+  'Mon, 06 Sep 2010 16:45:00 GMT',
+  'Mon, 06 Sep 2010 16:45:00 +0000',
+  'Mon, 6 Sep 2010 09:45:00 -0700',
+  'Mon, 06 Sep 2010 16:45:00 EDT',
+  '06 Sep 2010 16:45:00 GMT',
+  'Mon, 06 Sep 10 16:45 PDT',
+  '2010-09-06T16:45:00Z',
+  '2010-09-06T16:45:00+02:00',
+  '2010-09-06T16:45:00.123-05:00',
+  '2010-09-06',
+  '20100906T164500Z',
+  '2010-09-06 16:45:00',
+  'Mon Sep  6 16:45:00 2010',
+]
+
+
+def make_dates(count):
+  """Distinct date strings, cycling through the formats in DATES"""
+  dates = []
+  for i in range(count):
+    date = DATES[i % len(DATES)]
+    dates.append(date.replace('06', '%02d' % (i / len(DATES) % 28 + 1), 1).replace(' 6 ', ' %d ' % (i / len(DATES) % 28 + 1), 1))
+  return dates
+
+
+def parse_dates(dates, cold):
+  cache = getattr(feedparser, '_date_cache', None)
+  for date in dates:
+    if cold and cache is not None:
+      cache.clear()
+    feedparser._parse_date(date)
+
+
+BODY_PARAGRAPH = """<p class="para" style="color: red">Paragraph %(i)d of a long post, with
+<a href="/posts/%(i)d" onclick="track()">a relative link</a>, <em>emphasis</em>,
+<img src="images/%(i)d.png" alt="figure %(i)d" width="300" height="200"> and
+&amp; an entity or two &copy; &#8212; <script>tracker(%(i)d)</script></p>
+<blockquote cite="http://example.org/quote/%(i)d"><p>A quote</p></blockquote>
+"""
+
+
+def make_body(paragraphs):
+  """A large item body, about 450 bytes per paragraph"""
+  return ''.join([BODY_PARAGRAPH % {'i': i} for i in range(paragraphs)])
+
+
+def clean_two_passes(body):
+  return feedparser._sanitizeHTML(feedparser._resolveRelativeURIs(body, 'http://example.com/blog/', 'utf-8'), 'utf-8')
+
+
+def clean_one_pass(body, cold):
+  if cold:
+    feedparser._clean_cache.clear()
+  return feedparser._cleanHTML(body, 'http://example.com/blog/', 'utf-8')
+
+
+# the entry keys FeedItem.process_entry reads, see FeedItem.PARSED_FIELDS
+FIELDS = ('link', 'feedburner_origlink', 'title', 'author', 'description', 'id', 'published', 'updated')
+
+
+def read_fields(result):
+  """The accesses FeedItem.process_entry makes for every entry"""
+  for entry in result.entries:
+    entry.get('link', '')
+    hasattr(entry, 'feedburner_origlink')
+    entry.get('title', '')
+    entry.get('author', '')
+    entry.get('description', '')
+    entry.get('id', '')
+    hasattr(entry, 'published') and entry.published_parsed
+    hasattr(entry, 'updated') and entry.updated_parsed
+
+
+def bench(name, func, rounds):
+  best = None
+  for i in range(rounds):
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  print '%-28s %8.2f ms' % (name, best * 1000)
+
+
+def main(entries=50, rounds=5):
+  rss = make_rss(entries)
+  atom = make_atom(entries)
+  rss_result = feedparser.parse(rss)
+  atom_result = feedparser.parse(atom)
+  print '%d entries, best of %d rounds' % (entries, rounds)
+  bench('parse rss', lambda: feedparser.parse(rss), rounds)
+  bench('parse atom', lambda: feedparser.parse(atom), rounds)
+  bench('parse rss, projected', lambda: feedparser.parse(rss, fields=FIELDS), rounds)
+  bench('parse atom, projected', lambda: feedparser.parse(atom, fields=FIELDS), rounds)
+  bench('field access x100', lambda: [read_fields(rss_result) for i in range(100)], rounds)
+  body = make_body(entries * 4)
+  kb = len(body) / 1024
+  bench('clean %dKB body, two passes' % kb, lambda: clean_two_passes(body), rounds)
+  bench('clean %dKB body, one pass' % kb, lambda: clean_one_pass(body, True), rounds)
+  bench('clean %dKB body, cached' % kb, lambda: clean_one_pass(body, False), rounds)
+  dates = make_dates(entries * 20)
+  bench('parse %d dates, cold' % len(dates), lambda: parse_dates(dates, True), rounds)
+  bench('parse %d dates, warm' % len(dates), lambda: parse_dates(dates, False), rounds)
+
+
+if __name__ == '__main__':
+  args = [int(arg) for arg in sys.argv[1:]]
+  main(*args)
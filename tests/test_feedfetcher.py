@@ -0,0 +1,160 @@
+import gzip
+import time
+from StringIO import StringIO
+from datetime import datetime, timedelta
+
+import unittest2
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+
+from lib import feedparser
+from lib.feedfetcher import FeedFetcher, FetchRequest, FetchResult, HostLimiter, format_http_date, interleave_hosts
+
+
+def gzipped(data):
+  buf = StringIO()
+  f = gzip.GzipFile(fileobj=buf, mode='wb')
+  f.write(data)
+  f.close()
+  return buf.getvalue()
+
+
+def fetch_result(status_code=200, headers=None):
+  result = FetchResult(FetchRequest('http://example.com/feed'))
+  result.status_code = status_code
+  result.headers = headers or {}
+  return result
+
+
+class FreshnessTest(unittest2.TestCase):
+
+  def testMaxAge(self):
+    self.assertEqual(fetch_result(headers={'cache-control': 'public, max-age=300'}).freshness(), 300)
+
+  def testNoCacheWins(self):
+    self.assertEqual(fetch_result(headers={'cache-control': 'no-cache, max-age=300'}).freshness(), None)
+
+  def testExpiresCountsFromServerDate(self):
+    headers = {'date': 'Mon, 06 Sep 2010 12:00:00 GMT', 'expires': 'Mon, 06 Sep 2010 12:10:00 GMT'}
+    self.assertEqual(fetch_result(headers=headers).freshness(), 600)
+
+  def testMaxAgeBeatsExpires(self):
+    headers = {'cache-control': 'max-age=60', 'date': 'Mon, 06 Sep 2010 12:00:00 GMT',
+               'expires': 'Mon, 06 Sep 2010 12:10:00 GMT'}
+    self.assertEqual(fetch_result(headers=headers).freshness(), 60)
+
+  def testInvalidExpiresIsStale(self):
+    self.assertEqual(fetch_result(headers={'expires': '0'}).freshness(), 0)
+
+  def testNoHint(self):
+    self.assertEqual(fetch_result().freshness(), None)
+
+
+class RetryAfterTest(unittest2.TestCase):
+
+  def testSeconds(self):
+    self.assertEqual(fetch_result(503, {'retry-after': '120'}).retry_after(), 120)
+
+  def testHttpDate(self):
+    when = format_http_date(datetime.utcnow() + timedelta(seconds=300))
+    wait = fetch_result(429, {'retry-after': when}).retry_after()
+    self.assertTrue(290 <= wait <= 300, wait)
+
+  def testDateInThePast(self):
+    self.assertEqual(fetch_result(503, {'retry-after': 'Mon, 06 Sep 2010 12:00:00 GMT'}).retry_after(), 0)
+
+  def testOnlyForBackOffResponses(self):
+    self.assertEqual(fetch_result(200, {'retry-after': '120'}).retry_after(), None)
+
+  def testGarbage(self):
+    self.assertEqual(fetch_result(503, {'retry-after': 'soon'}).retry_after(), None)
+    self.assertEqual(fetch_result(503).retry_after(), None)
+
+
+class InterleaveHostsTest(unittest2.TestCase):
+
+  def testRoundRobin(self):
+    urls = ['http://a.com/1', 'http://a.com/2', 'http://a.com/3', 'http://b.com/1', 'http://C.com/1', 'http://b.com/2']
+    self.assertEqual(interleave_hosts(urls, url=lambda url: url),
+                     ['http://a.com/1', 'http://b.com/1', 'http://C.com/1',
+                      'http://a.com/2', 'http://b.com/2', 'http://a.com/3'])
+
+  def testEmpty(self):
+    self.assertEqual(interleave_hosts([]), [])
+
+
+class HostLimiterTest(unittest2.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testConcurrency(self):
+    limiter = HostLimiter(rate=100, concurrency=2)
+    self.assertTrue(limiter.acquire('http://a.com/1'))
+    self.assertTrue(limiter.acquire('http://a.com/2'))
+    self.assertFalse(limiter.acquire('http://a.com/3'))
+    # other hosts have budgets of their own
+    self.assertTrue(limiter.acquire('http://b.com/1'))
+    limiter.release('http://a.com/1')
+    self.assertTrue(limiter.acquire('http://a.com/3'))
+
+  def testRate(self):
+    limiter = HostLimiter(rate=2, concurrency=100)
+    # start on a fresh second so all acquires share one rate counter
+    time.sleep(1 - time.time() % 1)
+    self.assertTrue(limiter.acquire('http://a.com/1'))
+    self.assertTrue(limiter.acquire('http://a.com/2'))
+    self.assertFalse(limiter.acquire('http://a.com/3'))
+
+  def testRateRejectionFreesInFlightSlot(self):
+    limiter = HostLimiter(rate=1, concurrency=100)
+    time.sleep(1 - time.time() % 1)
+    limiter.acquire('http://a.com/1')
+    limiter.acquire('http://a.com/2')
+    self.assertEqual(memcache.get(limiter._in_flight_key('a.com')), 1)
+
+  def testConcurrencyRejectionKeepsRateBudget(self):
+    limiter = HostLimiter(rate=2, concurrency=1)
+    time.sleep(1 - time.time() % 1)
+    self.assertTrue(limiter.acquire('http://a.com/1'))
+    self.assertFalse(limiter.acquire('http://a.com/2'))
+    limiter.release('http://a.com/1')
+    self.assertTrue(limiter.acquire('http://a.com/2'))
+
+  def testNoHost(self):
+    self.assertTrue(HostLimiter(rate=0, concurrency=0).acquire('/relative'))
+
+
+class DecompressTest(unittest2.TestCase):
+
+  def decompress(self, status_code, content, max_body=1024):
+    result = fetch_result(status_code, {'content-encoding': 'gzip'})
+    result.content = content
+    FeedFetcher(max_body=max_body)._decompress(result)
+    return result
+
+  def testGzip(self):
+    result = self.decompress(200, gzipped('<rss/>'))
+    self.assertEqual((result.content, result.error), ('<rss/>', None))
+    self.assertFalse('content-encoding' in result.headers)
+
+  def testPartialBody(self):
+    # a Range response cuts the stream short, what inflates is kept
+    body = '<rss>' + ''.join([str(i) for i in range(200)])
+    result = self.decompress(206, gzipped(body)[:-20])
+    self.assertEqual(result.error, None)
+    self.assertTrue(result.content.startswith('<rss>0123'))
+    self.assertTrue(body.startswith(result.content))
+
+  def testPartialBodyBounded(self):
+    result = self.decompress(206, gzipped('\0' * (1024 * 1024))[:-20])
+    self.assertTrue(isinstance(result.error, feedparser.BodyTooLarge))
+
+  def testFullBodyBounded(self):
+    result = self.decompress(200, gzipped('\0' * (1024 * 1024)))
+    self.assertTrue(isinstance(result.error, feedparser.BodyTooLarge))
@@ -0,0 +1,127 @@
+import time
+
+import unittest2
+
+from lib import feedfinder
+
+RSS = '<rss version="2.0"><channel><title>feed</title></channel></rss>'
+HTML = '<html><head><title>page</title></head><body></body></html>'
+
+
+class SniffTest(unittest2.TestCase):
+
+  def testDeclarationAndDoctypeBeforeRss(self):
+    data = ('<?xml version="1.0" encoding="utf-8"?>\n<!-- generator -->\n'
+            '<!DOCTYPE rss PUBLIC "-//Netscape Communications//DTD RSS 0.91//EN" '
+            '"http://my.netscape.com/publish/formats/rss-0.91.dtd">\n' + RSS)
+    self.assertEqual(feedfinder.sniffRootElement(data), 'rss')
+    self.assertTrue(feedfinder.couldBeFeedData(data))
+
+  def testDoctypeWithInternalSubset(self):
+    data = '<?xml version="1.0"?><!DOCTYPE rss [<!ENTITY nbsp "&#160;">]>' + RSS
+    self.assertEqual(feedfinder.sniffRootElement(data), 'rss')
+
+  def testHtmlDoctype(self):
+    data = '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN">\n' + HTML
+    self.assertEqual(feedfinder.sniffRootElement(data), 'html')
+    self.assertFalse(feedfinder.couldBeFeedData(data))
+
+  def testHtmlMentioningFeeds(self):
+    data = HTML.replace('<body>', '<body><p>Subscribe to our &lt;rss&gt; <a href="/feed">feed</a></p>')
+    self.assertFalse(feedfinder.couldBeFeedData(data))
+
+  def testAtom(self):
+    data = '<?xml version="1.0" encoding="utf-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom"><title>t</title></feed>'
+    self.assertEqual(feedfinder.sniffRootElement(data), 'feed')
+    self.assertTrue(feedfinder.couldBeFeedData(data))
+
+  def testRdf(self):
+    data = '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"><channel/></rdf:RDF>'
+    self.assertTrue(feedfinder.couldBeFeedData(data))
+
+  def testTruncatedRangeResponse(self):
+    # a Range request hands back the first SNIFF_SIZE bytes, cut off mid document
+    data = ('<?xml version="1.0"?>\n' + RSS.replace('</channel>', '<item>x</item>' * 1000 + '</channel>'))[:feedfinder.SNIFF_SIZE]
+    self.assertEqual(len(data), 4096)
+    self.assertTrue(feedfinder.couldBeFeedData(data))
+
+  def testRootBeyondSniffSize(self):
+    data = '<!--' + ' ' * feedfinder.SNIFF_SIZE + '-->' + HTML
+    self.assertEqual(feedfinder.sniffRootElement(data[:feedfinder.SNIFF_SIZE]), None)
+    self.assertFalse(feedfinder.couldBeFeedData(data))
+
+  def testCutMidTag(self):
+    self.assertEqual(feedfinder.sniffRootElement('<?xml version="1.0"?><rs'), None)
+    self.assertEqual(feedfinder.sniffRootElement('<?xml version="1.0"'), None)
+
+
+class FakeGatekeeper(feedfinder.URLGatekeeper):
+  """Answers sniffs from a dict of url to body, recording every window"""
+
+  def __init__(self, pages, delay=0):
+    feedfinder.URLGatekeeper.__init__(self)
+    self.pages = pages
+    self.delay = delay
+    self.windows = []
+    self.timeouts = []
+
+  def sniffAll(self, urls, size=feedfinder.SNIFF_SIZE, timeout=None):
+    self.windows.append(urls)
+    self.timeouts.append(timeout)
+    if self.delay:
+      time.sleep(self.delay)
+    return [self.pages.get(url, HTML) for url in urls]
+
+
+class ProbeFeedsTest(unittest2.TestCase):
+
+  def setUp(self):
+    self.gatekeeper = feedfinder._gatekeeper
+
+  def tearDown(self):
+    feedfinder.setGatekeeper(self.gatekeeper)
+
+  def probe(self, pages, tiers, **kwargs):
+    gatekeeper = FakeGatekeeper(pages, kwargs.pop('delay', 0))
+    feedfinder.setGatekeeper(gatekeeper)
+    return feedfinder.probeFeeds(tiers, **kwargs), gatekeeper
+
+  def testHigherTierWins(self):
+    found, gatekeeper = self.probe({'b': RSS, 'c': RSS}, [['a', 'b'], ['c']])
+    self.assertEqual(found, ['b'])
+
+  def testLowerTierWhenNothingBetter(self):
+    found, gatekeeper = self.probe({'c': RSS, 'd': RSS}, [['a', 'b'], ['c', 'd']])
+    self.assertEqual(found, ['c', 'd'])
+
+  def testFirst(self):
+    found, gatekeeper = self.probe({'c': RSS, 'd': RSS}, [['a', 'b'], ['c', 'd']], first=True)
+    self.assertEqual(found, ['c'])
+
+  def testAll(self):
+    found, gatekeeper = self.probe({'b': RSS, 'c': RSS}, [['a', 'b'], ['c']], all=True)
+    self.assertEqual(found, ['b', 'c'])
+
+  def testStopsOnceTopTierConfirmed(self):
+    tiers = [['a'], ['b%d' % i for i in range(10)]]
+    found, gatekeeper = self.probe({'a': RSS}, tiers)
+    self.assertEqual(found, ['a'])
+    self.assertEqual(len(gatekeeper.windows), 1)
+    self.assertEqual(len(gatekeeper.windows[0]), feedfinder.PROBE_CONCURRENCY)
+
+  def testDuplicatesProbedOnce(self):
+    found, gatekeeper = self.probe({}, [['a', 'b'], ['a', 'c']])
+    self.assertEqual(gatekeeper.windows, [['a', 'b', 'c']])
+
+  def testGivesUpAtDeadline(self):
+    tiers = [['u%d' % i for i in range(feedfinder.PROBE_CONCURRENCY * 5)]]
+    found, gatekeeper = self.probe({}, tiers, deadline=0.5, delay=0.3)
+    self.assertEqual(found, [])
+    self.assertEqual(len(gatekeeper.windows), 2)
+    # each window only gets the time that is left
+    self.assertTrue(gatekeeper.timeouts[0] <= 0.5)
+    self.assertTrue(gatekeeper.timeouts[1] <= 0.2)
+
+  def testDefaultDeadline(self):
+    found, gatekeeper = self.probe({}, [['a']])
+    self.assertTrue(gatekeeper.timeouts[0] <= feedfinder.PROBE_DEADLINE)
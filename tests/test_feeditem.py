@@ -0,0 +1,143 @@
+import unittest2
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+from lib import feedparser
+from models import FeedSource, FeedItem, ItemSequence
+
+RSS = """<?xml version="1.0"?>
+<rss version="2.0"><channel><title>feed</title>%s</channel></rss>"""
+
+RSS_ITEM = """<item><title>%(title)s</title><link>http://example.com/%(id)s</link>
+<guid>tag:example.com,2010:%(id)s</guid><description>Entry %(id)s</description>
+<pubDate>Mon, 06 Sep 2010 16:45:00 GMT</pubDate></item>"""
+
+
+class FeedItemTest(unittest2.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.source = FeedSource(key_name=FeedSource.key_name_for_url('http://example.com/feed'),
+                             url='http://example.com/feed')
+    self.source.put()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def items(self, *entries):
+    """FeedItems for (id, title) pairs, as a poll of the source would make them"""
+    xml = RSS % ''.join([RSS_ITEM % {"id": id, "title": title} for id, title in entries])
+    d = feedparser.parse(xml, fields=FeedItem.PARSED_FIELDS)
+    return [FeedItem.process_entry(entry, self.source) for entry in d['entries']]
+
+
+class FingerprintTest(FeedItemTest):
+
+  def testStableAcrossParses(self):
+    self.assertEqual(self.items(('1', 'first'))[0].fingerprint, self.items(('1', 'first'))[0].fingerprint)
+
+  def testChangesWithContent(self):
+    self.assertNotEqual(self.items(('1', 'first'))[0].fingerprint, self.items(('1', 'edited'))[0].fingerprint)
+
+  def testEditKeepsKey(self):
+    self.assertEqual(self.items(('1', 'first'))[0].key(), self.items(('1', 'edited'))[0].key())
+
+  def testMissingFingerprintIsComputed(self):
+    item = self.items(('1', 'first'))[0]
+    fingerprint = item.fingerprint
+    item.fingerprint = None
+    self.assertEqual(item.revision(), fingerprint)
+
+
+class ClassifyTest(FeedItemTest):
+
+  def testAllNew(self):
+    new, changed, unchanged = FeedItem.classify(self.source, self.items(('1', 'a'), ('2', 'b')))
+    self.assertEqual((len(new), len(changed), len(unchanged)), (2, 0, 0))
+
+  def testStoredItems(self):
+    db.put(self.items(('1', 'a'), ('2', 'b')))
+    new, changed, unchanged = FeedItem.classify(self.source, self.items(('1', 'a'), ('2', 'edited'), ('3', 'c')))
+    self.assertEqual([item.id for item in new], ['tag:example.com,2010:3'])
+    self.assertEqual([item.title for item in changed], ['edited'])
+    self.assertEqual([item.id for item in unchanged], ['tag:example.com,2010:1'])
+
+  def testChangedKeepsCreationTime(self):
+    stored = self.items(('1', 'a'))[0]
+    stored.put()
+    new, changed, unchanged = FeedItem.classify(self.source, self.items(('1', 'edited')))
+    self.assertEqual(changed[0].created, stored.created)
+
+  def testRepeatsDropped(self):
+    new, changed, unchanged = FeedItem.classify(self.source, self.items(('1', 'a'), ('1', 'a')))
+    self.assertEqual((len(new), len(changed), len(unchanged)), (1, 0, 0))
+
+
+class SeenCacheTest(FeedItemTest):
+
+  def setUp(self):
+    FeedItemTest.setUp(self)
+    self.cache_size = FeedItem.SEEN_CACHE_SIZE
+
+  def tearDown(self):
+    FeedItem.SEEN_CACHE_SIZE = self.cache_size
+    FeedItemTest.tearDown(self)
+
+  def seen(self):
+    return [name for name, revision in FeedItem._recently_seen(self.source)]
+
+  def testSeenItemsSkipTheDatastore(self):
+    items = self.items(('1', 'a'))
+    FeedItem.mark_seen(self.source, items)
+    # nothing is stored, only the cache can tell the item is known
+    new, changed, unchanged = FeedItem.classify(self.source, self.items(('1', 'a')))
+    self.assertEqual((len(new), len(changed), len(unchanged)), (0, 0, 1))
+
+  def testEditedItemsAreChecked(self):
+    items = self.items(('1', 'a'))
+    db.put(items)
+    FeedItem.mark_seen(self.source, items)
+    new, changed, unchanged = FeedItem.classify(self.source, self.items(('1', 'edited')))
+    self.assertEqual((len(new), len(changed), len(unchanged)), (0, 1, 0))
+
+  def testOldestDroppedFirst(self):
+    FeedItem.SEEN_CACHE_SIZE = 2
+    a, b, c = self.items(('a', 'a'), ('b', 'b'), ('c', 'c'))
+    FeedItem.mark_seen(self.source, [a, b])
+    FeedItem.mark_seen(self.source, [c])
+    self.assertEqual(self.seen(), [b.key().name(), c.key().name()])
+
+  def testSeenAgainMovesToTheEnd(self):
+    FeedItem.SEEN_CACHE_SIZE = 2
+    a, b, c = self.items(('a', 'a'), ('b', 'b'), ('c', 'c'))
+    FeedItem.mark_seen(self.source, [a, b])
+    FeedItem.mark_seen(self.source, [a])
+    FeedItem.mark_seen(self.source, [c])
+    self.assertEqual(self.seen(), [a.key().name(), c.key().name()])
+
+
+class StoreTest(FeedItemTest):
+
+  def testNewItemsNumberedInOrder(self):
+    FeedItem.store(self.source, self.items(('1', 'a'), ('2', 'b')))
+    FeedItem.store(self.source, self.items(('3', 'c')))
+    items = FeedItem.all().ancestor(self.source).order('seq').fetch(10)
+    self.assertEqual([(item.title, item.seq) for item in items], [('a', 1), ('b', 2), ('c', 3)])
+    self.assertEqual(ItemSequence.current(self.source.key()), 3)
+
+  def testChangedItemsKeepTheirNumber(self):
+    FeedItem.store(self.source, self.items(('1', 'a'), ('2', 'b')))
+    new, changed, unchanged = FeedItem.classify(self.source, self.items(('1', 'edited'), ('3', 'c')))
+    FeedItem.store(self.source, new, changed)
+    items = FeedItem.all().ancestor(self.source).order('seq').fetch(10)
+    self.assertEqual([(item.title, item.seq) for item in items], [('edited', 1), ('b', 2), ('c', 3)])
+
+  def testLargeBatches(self):
+    FeedItem.store(self.source, self.items(*[(str(i), str(i)) for i in range(FeedItem.STORE_BATCH_SIZE + 5)]))
+    self.assertEqual(ItemSequence.current(self.source.key()), FeedItem.STORE_BATCH_SIZE + 5)
+
+  def testNothingStoredYet(self):
+    self.assertEqual(ItemSequence.current(self.source.key()), 0)
@@ -0,0 +1,137 @@
+import gzip
+import xml.sax
+import zlib
+from StringIO import StringIO
+
+import unittest2
+
+from lib import feedparser
+
+
+def gzipped(data):
+  buf = StringIO()
+  f = gzip.GzipFile(fileobj=buf, mode='wb')
+  f.write(data)
+  f.close()
+  return buf.getvalue()
+
+
+def deflated(data):
+  # raw deflate stream, without the zlib header and checksum
+  return zlib.compress(data)[2:-4]
+
+
+class ReadBodyTest(unittest2.TestCase):
+
+  BODY = '<rss><channel><title>feed</title></channel></rss>' * 1000
+
+  def read(self, data, encoding=None, max_bytes=None):
+    return feedparser._readBody(StringIO(data), encoding, max_bytes)
+
+  def testPlain(self):
+    self.assertEqual(self.read(self.BODY, max_bytes=len(self.BODY)), self.BODY)
+
+  def testPlainTooLarge(self):
+    self.assertRaises(feedparser.BodyTooLarge, self.read, self.BODY, max_bytes=len(self.BODY) - 1)
+
+  def testGzip(self):
+    self.assertEqual(self.read(gzipped(self.BODY), 'gzip', len(self.BODY)), self.BODY)
+
+  def testDeflate(self):
+    self.assertEqual(self.read(deflated(self.BODY), 'deflate', len(self.BODY)), self.BODY)
+
+  def testInflatedTooLarge(self):
+    # compresses to well under the limit, inflates to far over it
+    bomb = gzipped('\0' * (10 * 1024 * 1024))
+    self.assertTrue(len(bomb) < feedparser.MAX_BODY_SIZE)
+    self.assertRaises(feedparser.BodyTooLarge, self.read, bomb, 'gzip', feedparser.MAX_BODY_SIZE)
+
+  def testUnbounded(self):
+    self.assertEqual(self.read(self.BODY * 10), self.BODY * 10)
+
+
+HUB_BODY = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>Hub topic</title>
+  <link rel="self" href="http://example.com/feed"/>
+  <entry>
+    <id>tag:example.com,2010:1</id>
+    <title>First &amp; foremost</title>
+    <link href="http://example.com/1"/>
+    <author><name>Ann</name></author>
+    <summary type="html">&lt;p&gt;Hello &lt;script&gt;x()&lt;/script&gt;&lt;/p&gt;</summary>
+    <published>2010-09-06T16:45:00Z</published>
+    <updated>2010-09-07T10:00:00Z</updated>
+  </entry>
+  <entry>
+    <id>tag:example.com,2010:2</id>
+    <title>Second</title>
+    <link href="http://example.com/2"/>
+    <summary>Plain \xc3\xa9t\xc3\xa9</summary>
+    <updated>2010-09-08T10:00:00Z</updated>
+  </entry>
+</feed>"""
+
+
+class IterparseTest(unittest2.TestCase):
+
+  def entries(self, fields=None):
+    # small chunks so entries straddle reads, as a hub POST body arrives
+    return [entry for feed, entry in feedparser.iterparse(StringIO(HUB_BODY), chunk_size=64, fields=fields)]
+
+  def testSameEntriesAsParse(self):
+    self.assertEqual(self.entries(), feedparser.parse(HUB_BODY)['entries'])
+
+  def testSameProjectedEntriesAsParse(self):
+    fields = ('link', 'title', 'author', 'description', 'id', 'published', 'updated')
+    self.assertEqual(self.entries(fields), feedparser.parse(HUB_BODY, fields=fields)['entries'])
+
+  def testMalformedBody(self):
+    body = HUB_BODY.replace('</entry>', '', 1)
+    stream = feedparser.iterparse(StringIO(body))
+    self.assertRaises(xml.sax.SAXException, list, stream)
+
+
+class SanitizerTest(unittest2.TestCase):
+  """Expected output is what the sgmllib sanitizer this replaced produced,
+  except where noted."""
+
+  def clean(self, html, base='http://example.com/base/'):
+    return feedparser._cleanHTML(html, base, 'utf-8')
+
+  def testScript(self):
+    self.assertEqual(self.clean('<p>hi<script>alert(1)</script> there</p>'), '<p>hi there</p>')
+
+  def testStyle(self):
+    # the old sanitizer dropped the tags but kept the style sheet as text
+    self.assertEqual(self.clean('<style>p{color:red}</style><p>x</p>'), '<p>x</p>')
+
+  def testUnacceptableElements(self):
+    self.assertEqual(self.clean('<applet code="x">in applet</applet>after'), 'after')
+    self.assertEqual(self.clean('<iframe src="http://evil"></iframe>kept'), 'kept')
+
+  def testEventHandlers(self):
+    self.assertEqual(self.clean('<a href="/x" onclick="evil()" onmouseover="e()">link</a>'),
+                     '<a href="http://example.com/x">link</a>')
+    self.assertEqual(self.clean('<img src="x.png" onerror="evil()">'), '<img src="http://example.com/base/x.png" />')
+
+  def testJavascriptURIs(self):
+    # the old sanitizer let these through
+    self.assertEqual(self.clean('<a href="javascript:alert(1)">js</a>'), '<a>js</a>')
+    self.assertEqual(self.clean('<a href="JaVaScRiPt:alert(1)">js</a>'), '<a>js</a>')
+    self.assertEqual(self.clean('<img src="javascript:alert(1)">'), '<img />')
+    self.assertEqual(self.clean('<a href="&#106;avascript&#58;alert(1)">js</a>'), '<a>js</a>')
+    self.assertEqual(self.clean('<a href=" java\tscript:alert(1)">js</a>', None), '<a>js</a>')
+    self.assertEqual(self.clean('<a href="data:text/html,x">d</a>'), '<a>d</a>')
+
+  def testAcceptableURIs(self):
+    self.assertEqual(self.clean('<a href="mailto:a@example.com">m</a>'), '<a href="mailto:a@example.com">m</a>')
+    self.assertEqual(self.clean('<a href="/?a=1&amp;b=2">x</a>'), '<a href="http://example.com/?a=1&b=2">x</a>')
+
+  def testAttributeQuoting(self):
+    # the old sanitizer cut the value at the quote and dropped the attributes after it
+    self.assertEqual(self.clean('<a title=\'say "hi"\' href="/a">q</a>'),
+                     '<a title="say &quot;hi&quot;" href="http://example.com/a">q</a>')
+
+  def testEntities(self):
+    self.assertEqual(self.clean('<p>a &amp; b &lt; c &#169; &eacute;</p>'), '<p>a &amp; b &lt; c &#169; &eacute;</p>')
@@ -0,0 +1,206 @@
+from datetime import datetime, timedelta
+
+import unittest2
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+from models import FeedPollerConfig, FeedSource, FeedStream
+
+
+class FeedSourceTest(unittest2.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def source(self, **kwargs):
+    return FeedSource(key_name=FeedSource.key_name_for_url('http://example.com/feed'),
+                      url='http://example.com/feed', **kwargs)
+
+  def assertAbout(self, when, seconds):
+    expected = datetime.utcnow() + timedelta(seconds=seconds)
+    self.assertTrue(abs(when - expected) < timedelta(seconds=5), "%s is not about %s" % (when, expected))
+
+
+class ScheduleTest(FeedSourceTest):
+
+  def testNewItemsPollSooner(self):
+    source = self.source(poll_interval=4 * 60 * 60)
+    source.schedule_next_poll(new_items=1)
+    self.assertEqual(source.poll_interval, 2 * 60 * 60)
+    self.assertEqual(source.unchanged_polls, 0)
+    self.assertAbout(source.next_poll_at, 2 * 60 * 60)
+
+  def testNothingNewBacksOff(self):
+    source = self.source(poll_interval=60 * 60)
+    source.schedule_next_poll()
+    self.assertEqual(source.poll_interval, 90 * 60)
+    self.assertEqual(source.unchanged_polls, 1)
+
+  def testIntervalStaysWithinBounds(self):
+    source = self.source(poll_interval=FeedSource.MAX_POLL_INTERVAL)
+    source.schedule_next_poll()
+    self.assertEqual(source.poll_interval, FeedSource.MAX_POLL_INTERVAL)
+    source = self.source(poll_interval=FeedSource.MIN_POLL_INTERVAL)
+    source.schedule_next_poll(new_items=10)
+    self.assertEqual(source.poll_interval, FeedSource.MIN_POLL_INTERVAL)
+
+  def testErrorsBackOffExponentially(self):
+    source = self.source(poll_interval=FeedSource.MIN_POLL_INTERVAL)
+    source.schedule_next_poll(error=True)
+    self.assertAbout(source.next_poll_at, FeedSource.MIN_POLL_INTERVAL * 2)
+    source.schedule_next_poll(error=True)
+    self.assertEqual(source.error_count, 2)
+    self.assertAbout(source.next_poll_at, FeedSource.MIN_POLL_INTERVAL * 4)
+
+
+class HoldOffTest(FeedSourceTest):
+
+  def testPushesNextPollOut(self):
+    source = self.source()
+    source.schedule_next_poll()
+    source.hold_off(FeedSource.MAX_POLL_INTERVAL / 2)
+    self.assertAbout(source.hold_until, FeedSource.MAX_POLL_INTERVAL / 2)
+    self.assertEqual(source.next_poll_at, source.hold_until)
+
+  def testNeverPullsNextPollIn(self):
+    source = self.source()
+    source.schedule_next_poll()
+    next_poll_at = source.next_poll_at
+    source.hold_off(60)
+    self.assertEqual(source.next_poll_at, next_poll_at)
+
+  def testCappedAtLongestInterval(self):
+    source = self.source()
+    source.hold_off(FeedSource.MAX_POLL_INTERVAL * 10)
+    self.assertAbout(source.next_poll_at, FeedSource.MAX_POLL_INTERVAL)
+
+  def testNoHint(self):
+    source = self.source()
+    source.schedule_next_poll()
+    next_poll_at = source.next_poll_at
+    source.hold_off(None)
+    self.assertEqual(source.hold_until, None)
+    self.assertEqual(source.next_poll_at, next_poll_at)
+
+
+class FollowTest(FeedSourceTest):
+
+  def stream_key(self, stream_id):
+    return db.Key.from_path('FeedStream', 'z%s' % stream_id)
+
+  def testFirstFollowerCreatesSource(self):
+    source, needs_poll = FeedSource.follow('HTTP://Example.com:80/feed', self.stream_key(1))
+    self.assertTrue(needs_poll)
+    self.assertEqual(source.url, 'http://example.com/feed')
+    self.assertEqual(source.followers, 1)
+    source, needs_poll = FeedSource.follow('http://example.com/feed', self.stream_key(2))
+    self.assertFalse(needs_poll)
+    self.assertEqual(source.followers, 2)
+
+  def testStreamCountedOnce(self):
+    FeedSource.follow('http://example.com/feed', self.stream_key(1))
+    source, needs_poll = FeedSource.follow('http://example.com/feed', self.stream_key(1))
+    self.assertFalse(needs_poll)
+    self.assertEqual(source.followers, 1)
+    self.assertTrue(FeedSource.unfollow(source.key(), self.stream_key(1)))
+    self.assertFalse(FeedSource.unfollow(source.key(), self.stream_key(1)))
+
+  def testLastUnfollowIdles(self):
+    source, needs_poll = FeedSource.follow('http://example.com/feed', self.stream_key(1))
+    FeedSource.follow('http://example.com/feed', self.stream_key(2))
+    self.assertFalse(FeedSource.unfollow(source.key(), self.stream_key(1)))
+    self.assertTrue(FeedSource.get(source.key()).active)
+    self.assertTrue(FeedSource.unfollow(source.key(), self.stream_key(2)))
+    self.assertFalse(FeedSource.get(source.key()).active)
+
+  def testFollowWakesIdleSource(self):
+    source, needs_poll = FeedSource.follow('http://example.com/feed', self.stream_key(1))
+    FeedSource.unfollow(source.key(), self.stream_key(1))
+    source, needs_poll = FeedSource.follow('http://example.com/feed', self.stream_key(2))
+    self.assertTrue(needs_poll)
+    self.assertTrue(source.active)
+    self.assertEqual(source.followers, 1)
+
+  def testStreamDeletedOnce(self):
+    stream = FeedStream(key_name='z1', stream_id='1', title='stream', url='http://example.com/feed')
+    stream.put()
+    self.assertTrue(stream.mark_deleted())
+    self.assertFalse(FeedStream.get_by_key_name('z1').mark_deleted())
+
+
+class ShardTest(FeedSourceTest):
+
+  def setUp(self):
+    FeedSourceTest.setUp(self)
+    FeedPollerConfig._INSTANCE = None
+
+  def tearDown(self):
+    FeedPollerConfig._INSTANCE = None
+    FeedSourceTest.tearDown(self)
+
+  def testFollowsConfiguredShardCount(self):
+    FeedPollerConfig(key_name='config', shards=3).put()
+    self.assertEqual(FeedSource.shard_count(), 3)
+    key_name = FeedSource.key_name_for_url('http://example.com/feed')
+    self.assertEqual(FeedSource.shard_for(key_name), int(key_name[1:9], 16) % 3)
+
+  def testAtLeastOneShard(self):
+    FeedPollerConfig(key_name='config', shards=0).put()
+    self.assertEqual(FeedSource.shard_count(), 1)
+
+
+class LeaseTest(FeedSourceTest):
+
+  def setUp(self):
+    FeedSourceTest.setUp(self)
+    self.feed, needs_poll = FeedSource.follow('http://example.com/feed', db.Key.from_path('FeedStream', 'z1'))
+
+  def expire_lease(self):
+    source = FeedSource.get(self.feed.key())
+    source.lease_expires = source.next_poll_at = datetime.utcnow() - timedelta(seconds=1)
+    source.put()
+
+  def testClaimedOnce(self):
+    claimed = FeedSource.claim_due(self.feed.shard, 'a', 10)
+    self.assertEqual([source.key() for source in claimed], [self.feed.key()])
+    self.assertEqual(claimed[0].lease_owner, 'a')
+    self.assertEqual(FeedSource.claim_due(self.feed.shard, 'b', 10), [])
+
+  def testSaveReleasesLease(self):
+    source = FeedSource.claim_due(self.feed.shard, 'a', 10)[0]
+    source.http_etag = '"v1"'
+    source.schedule_next_poll()
+    self.assertTrue(source.save_poll())
+    stored = FeedSource.get(self.feed.key())
+    self.assertEqual(stored.http_etag, '"v1"')
+    self.assertEqual(stored.lease_owner, None)
+    self.assertEqual(stored.next_poll_at, source.next_poll_at)
+
+  def testLostLeaseDropsResults(self):
+    source = FeedSource.claim_due(self.feed.shard, 'a', 10)[0]
+    self.expire_lease()
+    FeedSource.claim_due(self.feed.shard, 'b', 10)
+    source.http_etag = '"stale"'
+    self.assertFalse(source.save_poll())
+    stored = FeedSource.get(self.feed.key())
+    self.assertEqual(stored.http_etag, None)
+    self.assertEqual(stored.lease_owner, 'b')
+
+  def testSaveKeepsOtherEdits(self):
+    source = FeedSource.claim_due(self.feed.shard, 'a', 10)[0]
+    FeedSource.follow('http://example.com/feed', db.Key.from_path('FeedStream', 'z2'))
+    source.schedule_next_poll()
+    source.save_poll()
+    self.assertEqual(FeedSource.get(self.feed.key()).followers, 2)
+
+  def testClaimWaitsForLiveLease(self):
+    FeedSource.claim_due(self.feed.shard, 'a', 10)
+    self.assertEqual(FeedSource.claim(self.feed.key(), 'b'), None)
+    self.expire_lease()
+    self.assertEqual(FeedSource.claim(self.feed.key(), 'b').lease_owner, 'b')
@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+import unittest2
+from google.appengine.ext import testbed
+
+from models import PollerHeartbeat
+
+
+class HeartbeatTest(unittest2.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def heartbeat(self):
+    return PollerHeartbeat.get(PollerHeartbeat.key_for(0))
+
+  def go_stale(self):
+    heartbeat = self.heartbeat()
+    heartbeat.last_beat = datetime.utcnow() - timedelta(seconds=PollerHeartbeat.STALE_TIME + 1)
+    heartbeat.put()
+
+  def testTakeOverFreshShard(self):
+    epoch = PollerHeartbeat.take_over(0)
+    self.assertNotEqual(epoch, None)
+    self.assertTrue(self.heartbeat().is_alive(datetime.utcnow()))
+
+  def testLiveChainKeepsShard(self):
+    PollerHeartbeat.take_over(0)
+    self.assertEqual(PollerHeartbeat.take_over(0), None)
+
+  def testDeadChainReplaced(self):
+    epoch = PollerHeartbeat.take_over(0)
+    self.go_stale()
+    self.assertFalse(self.heartbeat().is_alive(datetime.utcnow()))
+    self.assertEqual(PollerHeartbeat.take_over(0), epoch + 1)
+    self.assertEqual(self.heartbeat().restarts, 1)
+
+  def testSleepingChainWokenWithoutRestart(self):
+    epoch = PollerHeartbeat.take_over(0)
+    self.assertTrue(PollerHeartbeat.beat(0, epoch, PollerHeartbeat.STATE_ASLEEP))
+    self.assertEqual(PollerHeartbeat.take_over(0), epoch + 1)
+    self.assertEqual(self.heartbeat().restarts, 0)
+
+  def testSupersededChainStops(self):
+    epoch = PollerHeartbeat.take_over(0)
+    self.go_stale()
+    PollerHeartbeat.take_over(0)
+    self.assertFalse(PollerHeartbeat.beat(0, epoch, PollerHeartbeat.STATE_RUNNING, 5))
+    self.assertEqual(self.heartbeat().polled, 0)
+
+  def testBeatCountsPolls(self):
+    epoch = PollerHeartbeat.take_over(0)
+    self.assertTrue(PollerHeartbeat.beat(0, epoch, PollerHeartbeat.STATE_RUNNING, 5, 30))
+    self.assertTrue(PollerHeartbeat.beat(0, epoch, PollerHeartbeat.STATE_RUNNING, 3))
+    heartbeat = self.heartbeat()
+    self.assertEqual((heartbeat.polled, heartbeat.last_batch, heartbeat.lag_seconds), (8, 3, 0))
+
+  def testOneOffWorkersLeaveTheChainAlone(self):
+    epoch = PollerHeartbeat.take_over(0)
+    self.assertTrue(PollerHeartbeat.beat(0, epoch, PollerHeartbeat.STATE_RUNNING, 5, 30))
+    before = self.heartbeat()
+    self.assertTrue(PollerHeartbeat.beat(0, None, PollerHeartbeat.STATE_RUNNING, 2))
+    heartbeat = self.heartbeat()
+    self.assertEqual((heartbeat.epoch, heartbeat.state, heartbeat.last_beat, heartbeat.last_batch, heartbeat.polled),
+                     (epoch, before.state, before.last_beat, 5, 5))
+    self.assertEqual(heartbeat.fanout_polled, 2)
+    self.assertNotEqual(heartbeat.last_fanout, None)
+
+  def testOneOffWorkersDontKeepAShardAlive(self):
+    self.assertTrue(PollerHeartbeat.beat(0, None, PollerHeartbeat.STATE_RUNNING, 2))
+    self.assertFalse(self.heartbeat().is_alive(datetime.utcnow()))
+    self.assertNotEqual(PollerHeartbeat.take_over(0), None)
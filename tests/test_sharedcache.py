@@ -0,0 +1,68 @@
+import pickle
+from datetime import datetime, timedelta
+
+import unittest2
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+
+from discovery import SharedCache, purge_expired_entries
+from models import CacheEntry
+
+
+class SharedCacheTest(unittest2.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.cache = SharedCache("test", 60)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def store_expired(self, key, value):
+    cache_key = self.cache._cache_key(key)
+    CacheEntry(key_name=cache_key, value=pickle.dumps(value, 2),
+               expires=datetime.utcnow() - timedelta(seconds=1)).put()
+    return cache_key
+
+  def testHit(self):
+    self.cache.set('a', 1)
+    self.assertEqual(self.cache.get('a'), 1)
+
+  def testMissingDefault(self):
+    self.assertEqual(self.cache.get('a', 'default'), 'default')
+
+  def testMemcacheMissFallsBackToDatastore(self):
+    self.cache['a'] = {"value": 1}
+    memcache.flush_all()
+    self.assertEqual(self.cache.get('a'), {"value": 1})
+    # and memcache has it again
+    self.assertEqual(memcache.get(self.cache._cache_key('a')), {"value": 1})
+
+  def testUnicodeKeys(self):
+    self.cache.set(u'http://example.com/\xe9', 'feed')
+    self.assertEqual(self.cache.get(u'http://example.com/\xe9'), 'feed')
+
+  def testExpiredEntryDroppedOnRead(self):
+    cache_key = self.store_expired('a', 1)
+    self.assertEqual(self.cache.get('a'), None)
+    self.assertEqual(CacheEntry.get_by_key_name(cache_key), None)
+
+  def testHitRate(self):
+    self.cache.set('a', 1)
+    self.cache.get('a')
+    self.cache.get('a')
+    self.cache.get('b')
+    self.assertEqual(self.cache.stats(), {"name": "test", "hits": 2, "misses": 1, "hit_rate": "66%"})
+
+  def testNoLookupsYet(self):
+    self.assertEqual(self.cache.stats()["hit_rate"], "-")
+
+  def testPurgeExpiredEntries(self):
+    expired = self.store_expired('a', 1)
+    self.cache.set('b', 2)
+    purge_expired_entries()
+    self.assertEqual(CacheEntry.get_by_key_name(expired), None)
+    self.assertNotEqual(CacheEntry.get_by_key_name(self.cache._cache_key('b')), None)
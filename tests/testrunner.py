@@ -1,5 +1,6 @@
 #!/usr/bin/python
 import optparse
+import os
 import sys
 # Install the Python unittest2 package before you run this script.
 import unittest2
@@ -15,6 +16,8 @@ def main(sdk_path, test_path):
     sys.path.insert(0, sdk_path)
     import dev_appserver
     dev_appserver.fix_sys_path()
+    # the app's own modules live next to the tests directory
+    sys.path.insert(0, os.path.join(os.path.abspath(test_path), '..'))
     suite = unittest2.loader.TestLoader().discover(test_path)
     unittest2.TextTestRunner(verbosity=2).run(suite)
 